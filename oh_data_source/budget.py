@@ -0,0 +1,140 @@
+"""
+Per-transfer limits on wall time, data downloaded and worker memory.
+
+One slow or very large Nightscout site shouldn't stall or kill a worker.
+crawl_collection checks the transfer's TransferBudget after every window:
+
+  * Above MEMORY_SOFT_FRACTION of the memory limit, later query windows are
+    made narrower, so fewer items are held at once.
+  * Once any limit is reached, crawling stops. Collections not finished are
+    recorded in `partial`, and their files are uploaded labelled as partial
+    (see ns_data_file).
+
+The memory limit is on how much the worker's memory grew since the transfer
+started, as Python rarely returns freed memory to the OS: a later transfer
+in the same process isn't charged for an earlier one. When transfers share
+a process (the gevent pool), only the one that has downloaded the most is
+stopped. Worker processes that grew past WORKER_MAX_MEMORY_MB are replaced
+after their task (see celery_config.py).
+
+Limits are set per worker with environment variables; 0 means no limit.
+If the broker limits how long a task may stay unacknowledged
+(CELERY_CONSUMER_TIMEOUT, see celery_config.py), the time limit is capped to
+finish well within it.
+"""
+import logging
+import os
+import resource
+import time
+import weakref
+
+TRANSFER_MAX_SECONDS = int(os.getenv('NS_TRANSFER_MAX_SECONDS', '14400'))
+TRANSFER_MAX_MB = int(os.getenv('NS_TRANSFER_MAX_MB', '1024'))
+TRANSFER_MAX_MEMORY_MB = int(os.getenv('NS_TRANSFER_MAX_MEMORY_MB', '300'))
+WORKER_MAX_MEMORY_MB = int(os.getenv('NS_WORKER_MAX_MEMORY_MB', '450'))
+
+# Seconds a task may stay unacknowledged before the broker closes the
+# worker's channel and redelivers it (RabbitMQ's consumer_timeout). 0 means
+# no limit.
+CONSUMER_TIMEOUT = int(os.getenv('CELERY_CONSUMER_TIMEOUT', '0'))
+
+# Seconds kept back from the consumer timeout for the uploads after a crawl.
+UPLOAD_RESERVE_SECONDS = 600
+
+if CONSUMER_TIMEOUT:
+    TRANSFER_MAX_SECONDS = min(
+        TRANSFER_MAX_SECONDS or CONSUMER_TIMEOUT,
+        max(CONSUMER_TIMEOUT - UPLOAD_RESERVE_SECONDS, CONSUMER_TIMEOUT // 2))
+
+# Fraction of the memory limit above which query windows are narrowed.
+MEMORY_SOFT_FRACTION = 0.75
+
+# Set up logging.
+logger = logging.getLogger(__name__)
+
+# Budgets of the transfers running in this process.
+_active = weakref.WeakSet()
+
+
+def current_memory():
+    """
+    Return the worker process's resident memory in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # Not Linux: fall back to the peak (in KB on Linux, bytes on macOS).
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class TransferBudget(object):
+    """
+    Track one transfer's time and bytes downloaded against its limits.
+    """
+    def __init__(self, max_seconds=TRANSFER_MAX_SECONDS,
+                 max_mb=TRANSFER_MAX_MB, max_memory_mb=TRANSFER_MAX_MEMORY_MB):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.started = time.time()
+        self.start_memory = current_memory()
+        self.bytes = 0
+        # Why the transfer stopped early, if it did.
+        self.reason = None
+        # Collection: time back to which its data is complete.
+        self.partial = {}
+        _active.add(self)
+
+    def add_bytes(self, count):
+        self.bytes += count
+
+    def memory_growth(self):
+        """
+        Return how much the process's memory grew since the transfer began.
+        """
+        return current_memory() - self.start_memory
+
+    def memory_pressure(self):
+        """
+        Return True if memory growth is above the soft limit.
+        """
+        return bool(self.max_memory) and (
+            self.memory_growth() > self.max_memory * MEMORY_SOFT_FRACTION)
+
+    def is_heaviest(self):
+        """
+        Return True if no other transfer in this process downloaded more.
+        """
+        return all(self.bytes >= other.bytes for other in list(_active))
+
+    def exceeded(self):
+        """
+        Return the reason the transfer is over budget, or None.
+        """
+        if self.reason:
+            return self.reason
+        if self.max_seconds and time.time() - self.started > self.max_seconds:
+            self.reason = 'time limit reached'
+        elif self.max_bytes and self.bytes > self.max_bytes:
+            self.reason = 'download limit reached'
+        elif (self.max_memory and self.memory_growth() > self.max_memory and
+                self.is_heaviest()):
+            self.reason = 'memory limit reached'
+        if self.reason:
+            logger.info('Transfer over budget: {}.'.format(self.reason))
+        return self.reason
+
+    def partial_reason(self):
+        """
+        Return why some collections are partial.
+        """
+        # Without a reason, only oversized responses were skipped.
+        return self.reason or 'some responses were too large'
+
+    def mark_partial(self, collection, complete_from):
+        """
+        Record that a collection's data is only complete back to a time.
+        """
+        self.partial[collection] = max(
+            self.partial.get(collection, complete_from), complete_from)
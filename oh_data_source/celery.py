@@ -15,24 +15,14 @@ from celery import Celery
 
 from django.conf import settings
 
-CELERY_BROKER_URL = os.getenv('CLOUDAMQP_URL', 'amqp://')
+from .celery_config import CELERY_BROKER_URL, CELERY_CONFIG
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE',
                       'oh_data_source.settings')
 
 app = Celery('oh_data_source', broker=CELERY_BROKER_URL)
-# Set up Celery with Heroku CloudAMQP (or AMQP in local dev).
-app.conf.update({
-    'BROKER_URL': CELERY_BROKER_URL,
-    # Recommended settings. See: https://www.cloudamqp.com/docs/celery.html
-    'BROKER_POOL_LIMIT': 1,
-    'BROKER_HEARTBEAT': None,
-    'BROKER_CONNECTION_TIMEOUT': 30,
-    'CELERY_RESULT_BACKEND': None,
-    'CELERY_SEND_EVENTS': False,
-    'CELERY_EVENT_QUEUE_EXPIRES': 60,
-})
+app.conf.update(CELERY_CONFIG)
 
 
 # Using a string here means the worker will not have to
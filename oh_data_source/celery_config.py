@@ -0,0 +1,54 @@
+"""
+Celery configuration shared by the full app (celery.py) and the slim worker
+entry point (worker.py).
+
+Transfers are long and I/O-bound, so workers are tuned for them:
+
+  * Tasks are acknowledged after they finish (acks late), so a transfer
+    interrupted by a worker restart is redelivered rather than lost.
+    xfer_to_open_humans is idempotent, so a redelivery doesn't repeat
+    uploads that already happened.
+  * Each worker process reserves only one task at a time (prefetch 1), so
+    short transfers aren't stuck behind a long one already running.
+  * On brokers with a visibility timeout (Redis, SQS), it is longer than a
+    transfer may run (see budget.py), so running tasks aren't redelivered.
+    RabbitMQ (e.g. CloudAMQP) ignores it: an unacknowledged task is limited
+    by the server's consumer_timeout instead (30 minutes by default on
+    recent versions), after which the worker's channel is closed and the
+    task redelivered. The consumer_timeout must be longer than a transfer
+    may run, plus any countdown the task waits for (see bulk_transfer.py),
+    as workers hold those tasks unacknowledged too. Set
+    CELERY_CONSUMER_TIMEOUT to the server's value and transfers are capped
+    to finish within it.
+  * With the prefork pool, a worker process whose memory grew past
+    NS_WORKER_MAX_MEMORY_MB is replaced after its task, as Python rarely
+    returns memory to the OS.
+"""
+import os
+
+from .budget import TRANSFER_MAX_SECONDS, WORKER_MAX_MEMORY_MB
+
+CELERY_BROKER_URL = os.getenv('CLOUDAMQP_URL', 'amqp://')
+
+# Seconds before an unacknowledged task is redelivered, on brokers that use
+# a visibility timeout. Defaults to the transfer time limit plus an hour.
+VISIBILITY_TIMEOUT = int(os.getenv(
+    'CELERY_VISIBILITY_TIMEOUT', (TRANSFER_MAX_SECONDS or 43200) + 3600))
+
+# Set up Celery with Heroku CloudAMQP (or AMQP in local dev).
+CELERY_CONFIG = {
+    'BROKER_URL': CELERY_BROKER_URL,
+    # Recommended settings. See: https://www.cloudamqp.com/docs/celery.html
+    'BROKER_POOL_LIMIT': 1,
+    'BROKER_HEARTBEAT': None,
+    'BROKER_CONNECTION_TIMEOUT': 30,
+    'CELERY_RESULT_BACKEND': None,
+    'CELERY_SEND_EVENTS': False,
+    'CELERY_EVENT_QUEUE_EXPIRES': 60,
+    # For long, I/O-bound transfers; see above.
+    'CELERY_ACKS_LATE': True,
+    'CELERYD_PREFETCH_MULTIPLIER': 1,
+    'BROKER_TRANSPORT_OPTIONS': {'visibility_timeout': VISIBILITY_TIMEOUT},
+    # In kilobytes; None means no limit.
+    'CELERYD_MAX_MEMORY_PER_CHILD': WORKER_MAX_MEMORY_MB * 1024 or None,
+}
@@ -0,0 +1,107 @@
+"""
+Filtering of entries by record type, and optionally by field.
+
+The entries collection mixes sensor glucose (sgv), meter glucose (mbg),
+calibration (cal) and other record types, and some uploaders add very
+frequent records that most users don't want. An EntriesFilter keeps the
+types asked for:
+
+  * The type filter is added to each query's find[] filters (which the crawl
+    relies on for its time windows too), so unwanted records are never
+    downloaded.
+  * Every item is checked again as it arrives, in case the server ignored
+    the filter. Records dropped here are counted in `skipped`.
+
+With core_fields_only, only ENTRY_CORE_FIELDS are kept in each record.
+"""
+from collections import Counter
+
+# Entry types that can be chosen individually; any others are 'other'.
+ENTRY_TYPES = ('sgv', 'mbg', 'cal')
+
+ENTRY_CORE_FIELDS = frozenset([
+    '_id', 'type', 'date', 'dateString', 'sgv', 'mbg', 'direction', 'noise',
+    'slope', 'intercept', 'scale',
+])
+
+
+class EntriesFilter(object):
+    """
+    Keep entries of the chosen types, optionally with core fields only.
+
+    types lists the ENTRY_TYPES to keep, plus 'other' for all other types.
+    """
+    def __init__(self, types, core_fields_only=False):
+        types = set(types)
+        self.types = types.intersection(ENTRY_TYPES)
+        self.keep_other = 'other' in types
+        self.fields = ENTRY_CORE_FIELDS if core_fields_only else None
+        self.skipped = Counter()
+
+    def params(self):
+        """
+        Return find[] query parameters selecting the chosen types.
+        """
+        if self.keep_other:
+            excluded = sorted(set(ENTRY_TYPES) - self.types)
+            if not excluded:
+                return {}
+            if len(excluded) == 1:
+                return {'find[type][$ne]': excluded[0]}
+            return {'find[type][$nin][]': excluded}
+        included = sorted(self.types)
+        if len(included) == 1:
+            return {'find[type]': included[0]}
+        return {'find[type][$in][]': included}
+
+    def keep(self, item):
+        entry_type = item.get('type')
+        if entry_type in ENTRY_TYPES:
+            return entry_type in self.types
+        return self.keep_other
+
+    def apply(self, items):
+        """
+        Return the items to keep, counting the rest in skipped.
+        """
+        kept = []
+        for item in items:
+            if not self.keep(item):
+                self.skipped[item.get('type') or 'untyped'] += 1
+                continue
+            if self.fields:
+                item = dict((key, value) for key, value in item.items()
+                            if key in self.fields)
+            kept.append(item)
+        return kept
+
+    def describe(self):
+        """
+        Return a short description of the filter and what it skipped.
+        """
+        types = sorted(self.types) + (['other'] if self.keep_other else [])
+        parts = ['types: ' + ', '.join(types)]
+        if self.params():
+            parts.append('filtered in queries')
+        if self.skipped:
+            parts.append('skipped ' + ', '.join(
+                '{} {}'.format(count, entry_type)
+                for entry_type, count in sorted(self.skipped.items())))
+        if self.fields:
+            parts.append('core fields only')
+        return '; '.join(parts)
+
+
+def entries_filter(types=None, core_fields_only=False):
+    """
+    Return an EntriesFilter, or None if it would keep everything.
+
+    If types is empty or None, all types are kept.
+    """
+    if not types:
+        types = ENTRY_TYPES + ('other',)
+    item_filter = EntriesFilter(types, core_fields_only)
+    if (item_filter.types == set(ENTRY_TYPES) and item_filter.keep_other and
+            not core_fields_only):
+        return None
+    return item_filter
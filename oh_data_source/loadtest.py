@@ -0,0 +1,46 @@
+"""
+A task for load testing the broker and worker settings.
+
+The loadtest_broker command queues many of these, some long and some short,
+and reads back when each one was queued, started and finished. Results are
+kept in the Django cache, as there's no Celery result backend.
+"""
+from __future__ import absolute_import
+
+import os
+import socket
+import time
+
+from celery import shared_task
+from django.core.cache import cache
+
+# Seconds to keep load test results.
+LOADTEST_RESULT_TTL = 3600
+
+
+def loadtest_cache_key(run_id, index):
+    return 'loadtest-{}-{}'.format(run_id, index)
+
+
+@shared_task
+def loadtest_task(run_id, index, seconds, queued_at):
+    """
+    Sleep for seconds, as a stand-in for an I/O-bound transfer.
+
+    Each delivery is recorded before sleeping, so one cut off by a worker
+    restart is still counted.
+    """
+    cache_key = loadtest_cache_key(run_id, index)
+    # runs counts deliveries: above 1, the task was redelivered.
+    result = cache.get(cache_key) or {'runs': 0}
+    result.update({
+        'queued': queued_at,
+        'started': time.time(),
+        'finished': None,
+        'worker': '{}:{}'.format(socket.gethostname(), os.getpid()),
+        'runs': result['runs'] + 1,
+    })
+    cache.set(cache_key, result, LOADTEST_RESULT_TTL)
+    time.sleep(seconds)
+    result['finished'] = time.time()
+    cache.set(cache_key, result, LOADTEST_RESULT_TTL)
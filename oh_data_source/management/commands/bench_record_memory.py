@@ -0,0 +1,98 @@
+"""
+Benchmark peak memory of holding devicestatus items as dicts vs. compact.
+
+A synthetic response of OpenAPS-style devicestatus items is read and parsed
+in a fresh interpreter for each mode. The growth in peak RSS, which includes
+the response body itself, is reported per 10k items.
+"""
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from django.core.management.base import BaseCommand
+
+MODES = {
+    'dicts': 'json.loads(content)',
+    'compact': 'parse_compact_records(content)',
+}
+
+# Peak RSS in kB. On Linux, ru_maxrss carries over the parent's peak across
+# fork/exec, so the per-process VmHWM is used where available.
+MEASURE_CODE = """
+import json, resource
+from oh_data_source.records import parse_compact_records
+
+def peak_rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+before = peak_rss_kb()
+with open({path!r}, 'rb') as f:
+    content = f.read()
+items = {expr}
+print(peak_rss_kb() - before)
+"""
+
+
+def make_devicestatus(i):
+    """
+    Return a synthetic OpenAPS devicestatus item.
+    """
+    created_at = '2019-03-01T{:02d}:{:02d}:00.000Z'.format(
+        (i // 60) % 24, i % 60)
+    return {
+        '_id': '5c78{:020x}'.format(i),
+        'device': 'openaps://phone',
+        'created_at': created_at,
+        'openaps': {
+            'iob': {'iob': 1.2, 'basaliob': 0.4, 'activity': 0.01,
+                    'time': created_at},
+            'suggested': {
+                'temp': 'absolute', 'bg': 120, 'tick': '+3',
+                'eventualBG': 110, 'insulinReq': 0, 'deliverAt': created_at,
+                'predBGs': {'IOB': list(range(120, 60, -2)),
+                            'ZT': list(range(120, 80, -2))},
+                'reason': 'COB: 0, Dev: 5, BGI: -1, ISF: 50, Target: 100',
+            },
+            'enacted': {'rate': 0.8, 'duration': 30, 'received': True,
+                        'timestamp': created_at},
+        },
+        'pump': {'clock': created_at, 'battery': {'voltage': 1.4},
+                 'reservoir': 140.5, 'status': {'status': 'normal'}},
+        'uploader': {'battery': 85},
+    }
+
+
+class Command(BaseCommand):
+    help = 'Compare peak RSS of dict and compact devicestatus items.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        n_items = options['items']
+        fd, path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump([make_devicestatus(i) for i in range(n_items)], f)
+            self.stdout.write('{} items, {:.1f} MB of JSON'.format(
+                n_items, os.path.getsize(path) / 1e6))
+            for mode in sorted(MODES):
+                code = MEASURE_CODE.format(path=path, expr=MODES[mode])
+                growth_kb = int(subprocess.check_output(
+                    [sys.executable, '-c', code]))
+                self.stdout.write('{}: peak RSS +{:.1f} MB per 10k items'
+                                  .format(mode, growth_kb / 1024.0 *
+                                          10000 / n_items))
+        finally:
+            os.remove(path)
@@ -0,0 +1,61 @@
+"""
+Benchmark worker cold start for the full and slim Celery entry points.
+
+Each run starts a fresh interpreter, loads the Celery app and imports its task
+modules (which also runs django.setup()), as a worker does before taking its
+first task. Use --max-seconds in CI to fail when the slim worker regresses.
+"""
+from __future__ import print_function
+
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+ENTRY_POINTS = {
+    'full': ('oh_data_source.celery', 'oh_data_source.settings'),
+    'slim': ('oh_data_source.worker', 'oh_data_source.worker_settings'),
+}
+
+STARTUP_CODE = """
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = '{settings}'
+from {module} import app
+app.loader.import_default_modules()
+"""
+
+
+def time_startup(module, settings):
+    """
+    Return seconds taken to start an interpreter and load a worker app.
+    """
+    code = STARTUP_CODE.format(module=module, settings=settings)
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code])
+    return time.time() - start
+
+
+class Command(BaseCommand):
+    help = 'Measure worker cold-start time for the full and slim entry points.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument(
+            '--max-seconds', type=float, default=None,
+            help='Fail if the slim worker median startup exceeds this.')
+
+    def handle(self, *args, **options):
+        medians = {}
+        for name in sorted(ENTRY_POINTS):
+            module, settings = ENTRY_POINTS[name]
+            times = sorted(time_startup(module, settings)
+                           for _ in range(options['runs']))
+            medians[name] = times[len(times) // 2]
+            self.stdout.write('{}: median {:.3f}s, min {:.3f}s, max {:.3f}s '
+                              '({} runs)'.format(name, medians[name], times[0],
+                                                 times[-1], len(times)))
+
+        if options['max_seconds'] and medians['slim'] > options['max_seconds']:
+            raise CommandError('Slim worker startup {:.3f}s exceeds {:.3f}s'
+                               .format(medians['slim'], options['max_seconds']))
@@ -0,0 +1,197 @@
+"""
+Queue Nightscout transfers for many members at once.
+
+The input is a CSV file with a header row and the columns oh_id and
+nightscout_url, plus optional after_date and before_date (YYYY-MM-DD). The
+URLs are the ones members supplied; like the web form, this command never
+stores them.
+
+Transfers are queued in batches, pausing between batches. Transfers to the
+same Nightscout host are spread out with Celery countdowns, so one server is
+never crawled by several workers at once. Workers hold a task unacknowledged
+while it waits for its countdown, so on RabbitMQ the longest countdown plus
+the transfer time limit must fit in the broker's consumer_timeout (see
+celery_config.py); if CELERY_CONSUMER_TIMEOUT is set, this is checked before
+anything is queued. Use --dry-run to check the file
+and see an estimate of each transfer's length without queueing anything.
+"""
+from __future__ import division
+
+import csv
+import math
+import time
+from collections import OrderedDict
+from urlparse import urlparse
+
+import arrow
+from django.core.management.base import BaseCommand, CommandError
+
+# Configures the broker the tasks are sent to.
+from oh_data_source.budget import CONSUMER_TIMEOUT, TRANSFER_MAX_SECONDS
+from oh_data_source.celery import app  # noqa
+from oh_data_source.models import OpenHumansMember
+from oh_data_source.nightscout_data import COLLECTIONS, probe_ns_site
+from oh_data_source.tasks import xfer_to_open_humans
+
+
+def host_of(url):
+    """
+    Return the host part of a Nightscout URL, as entered by a member.
+    """
+    if not url.startswith('http'):
+        url = 'https://' + url
+    return urlparse(url).netloc.lower()
+
+
+def invalid_dates(row):
+    """
+    Return the row's date values that aren't valid YYYY-MM-DD dates.
+    """
+    invalid = []
+    for column in ('after_date', 'before_date'):
+        if row[column]:
+            try:
+                arrow.get(row[column], 'YYYY-MM-DD')
+            except (arrow.parser.ParserError, ValueError):
+                invalid.append(row[column])
+    return invalid
+
+
+def estimate_queries(probe, before_date, after_date):
+    """
+    Return the number of window queries a transfer is expected to make.
+    """
+    end = arrow.get(before_date) if before_date else arrow.get()
+    queries = 0
+    for collection, conf in COLLECTIONS.items():
+        start = arrow.get(after_date or conf['floor'])
+        earliest = probe['earliest'].get(collection) if probe else None
+        if earliest:
+            start = max(start, arrow.get(earliest))
+        if start < end:
+            span = (end - start).total_seconds()
+            queries += int(math.ceil(span / conf['window'].total_seconds()))
+    # The profile query.
+    return queries + 1
+
+
+class Command(BaseCommand):
+    help = 'Queue Nightscout transfers for the members listed in a CSV file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file')
+        parser.add_argument('--batch-size', type=int, default=20,
+                            help='Transfers queued per batch.')
+        parser.add_argument('--batch-delay', type=float, default=60,
+                            help='Seconds to wait between batches.')
+        parser.add_argument('--host-interval', type=int, default=600,
+                            help='Seconds between transfers to one host.')
+        parser.add_argument('--seconds-per-query', type=float, default=2,
+                            help='Assumed query time, for estimates.')
+        parser.add_argument('--daily-summary', action='store_true',
+                            help='Also upload daily summary files.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Check and estimate, but queue nothing.')
+
+    def read_rows(self, csv_file):
+        with open(csv_file, 'rb') as f:
+            rows = list(csv.DictReader(f))
+        if rows and not {'oh_id', 'nightscout_url'} <= set(rows[0]):
+            raise CommandError('CSV needs oh_id and nightscout_url columns.')
+        for row in rows:
+            # DictReader fills in missing trailing columns with None.
+            for column in ('after_date', 'before_date'):
+                row[column] = (row.get(column) or '').strip()
+        return rows
+
+    def handle(self, *args, **options):
+        rows = self.read_rows(options['csv_file'])
+
+        # Group by host, so each host's transfers can be spaced out.
+        by_host = OrderedDict()
+        missing = []
+        invalid = []
+        for row in rows:
+            if invalid_dates(row):
+                invalid.append('{} ({})'.format(
+                    row['oh_id'], ', '.join(invalid_dates(row))))
+                continue
+            if not OpenHumansMember.objects.filter(
+                    oh_id=row['oh_id']).exists():
+                missing.append(row['oh_id'])
+                continue
+            by_host.setdefault(host_of(row['nightscout_url']), []).append(row)
+
+        longest_host = max([len(r) for r in by_host.values()] or [0])
+        last_countdown = max(longest_host - 1, 0) * options['host_interval']
+        unacked_seconds = last_countdown + TRANSFER_MAX_SECONDS
+        if CONSUMER_TIMEOUT and unacked_seconds > CONSUMER_TIMEOUT:
+            message = (
+                'The last transfers start after {}s and may run {}s, longer '
+                'than the broker consumer timeout ({}s). Use a shorter '
+                '--host-interval, or split the file.'.format(
+                    last_countdown, TRANSFER_MAX_SECONDS, CONSUMER_TIMEOUT))
+            if not options['dry_run']:
+                raise CommandError(message)
+            self.stdout.write('Warning: ' + message)
+
+        queued = 0
+        unreachable = 0
+        total_seconds = 0
+        batch = 0
+        for host_number, (host, host_rows) in enumerate(by_host.items()):
+            for position, row in enumerate(host_rows):
+                countdown = position * options['host_interval']
+                if options['dry_run']:
+                    probe = probe_ns_site(row['nightscout_url'])
+                    if not probe:
+                        unreachable += 1
+                        self.stdout.write('{}: host #{} unreachable'.format(
+                            row['oh_id'], host_number))
+                        continue
+                    seconds = (options['seconds_per_query'] *
+                               estimate_queries(probe, row['before_date'],
+                                                row['after_date']))
+                    total_seconds += seconds
+                    self.stdout.write(
+                        '{}: host #{}, starts after {}s, ~{:.0f} min'.format(
+                            row['oh_id'], host_number, countdown,
+                            seconds / 60))
+                    continue
+
+                if batch == options['batch_size']:
+                    self.stdout.write('Queued {} of {}; pausing {}s...'.format(
+                        queued, len(rows), options['batch_delay']))
+                    time.sleep(options['batch_delay'])
+                    batch = 0
+                xfer_to_open_humans.apply_async(kwargs={
+                    'oh_id': row['oh_id'],
+                    'ns_before': row['before_date'],
+                    'ns_after': row['after_date'],
+                    'ns_url': row['nightscout_url'],
+                    'daily_summary': options['daily_summary'],
+                }, countdown=countdown)
+                oh_member = OpenHumansMember.objects.get(oh_id=row['oh_id'])
+                oh_member.last_xfer_datetime = arrow.get().format()
+                oh_member.save(update_fields=['last_xfer_datetime'])
+                oh_member.set_xfer_status('Queued')
+                queued += 1
+                batch += 1
+
+        self.stdout.write('')
+        self.stdout.write('Members: {}, hosts: {}'.format(
+            len(rows) - len(missing) - len(invalid), len(by_host)))
+        if missing:
+            self.stdout.write('Unknown members skipped: {}'.format(
+                ', '.join(missing)))
+        if invalid:
+            self.stdout.write('Members with invalid dates skipped: {}'.format(
+                ', '.join(invalid)))
+        if options['dry_run']:
+            self.stdout.write('Unreachable: {}'.format(unreachable))
+            self.stdout.write(
+                'Estimated transfer time: {:.1f} worker-hours; last '
+                'transfers start after {:.1f} hours'.format(
+                    total_seconds / 3600, last_countdown / 3600))
+        else:
+            self.stdout.write('Queued: {}'.format(queued))
@@ -0,0 +1,80 @@
+"""
+Load test the broker and worker settings with long and short tasks.
+
+Queues --long tasks that sleep --long-seconds (stand-ins for long
+transfers), then --short tasks that sleep --short-seconds, and waits for
+them. With prefetch 1 and acks late (see celery_config.py), short tasks
+should start as soon as any worker slot is free, not wait behind long tasks
+reserved by a busy process. Restart the worker during a run to check that
+interrupted tasks are redelivered rather than lost.
+
+Start a worker with the Procfile's options plus the load test task against
+a local broker, e.g.:
+  celery -A oh_data_source.worker worker -I oh_data_source.loadtest -O fair
+then run this command.
+"""
+from __future__ import division
+
+import time
+import uuid
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from oh_data_source.loadtest import loadtest_cache_key, loadtest_task
+
+
+class Command(BaseCommand):
+    help = 'Load test the broker and workers with long and short tasks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--long', type=int, default=4)
+        parser.add_argument('--long-seconds', type=float, default=30)
+        parser.add_argument('--short', type=int, default=20)
+        parser.add_argument('--short-seconds', type=float, default=0.5)
+        parser.add_argument('--timeout', type=float, default=600,
+                            help='Seconds to wait for all tasks.')
+
+    def handle(self, *args, **options):
+        run_id = uuid.uuid4().hex[:8]
+        durations = ([options['long_seconds']] * options['long'] +
+                     [options['short_seconds']] * options['short'])
+        for index, seconds in enumerate(durations):
+            loadtest_task.delay(run_id, index, seconds, time.time())
+        self.stdout.write('Queued {} tasks (run {}).'.format(
+            len(durations), run_id))
+
+        keys = [loadtest_cache_key(run_id, index)
+                for index in range(len(durations))]
+        deadline = time.time() + options['timeout']
+        results = {}
+        while len(results) < len(keys) and time.time() < deadline:
+            time.sleep(1)
+            # Tasks are recorded when they start; keep the finished ones.
+            results = dict((key, result) for key, result
+                           in cache.get_many(keys).items()
+                           if result['finished'])
+        if not results:
+            raise CommandError('No tasks finished. Is a worker running?')
+
+        short_waits = sorted(
+            results[key]['started'] - results[key]['queued']
+            for key in keys[options['long']:] if key in results)
+        blocked = [wait for wait in short_waits
+                   if wait > options['long_seconds'] * 0.9]
+        redelivered = sum(1 for result in results.values()
+                          if result['runs'] > 1)
+        workers = set(result['worker'] for result in results.values())
+
+        self.stdout.write('Finished: {} of {}'.format(
+            len(results), len(keys)))
+        self.stdout.write('Lost: {}'.format(len(keys) - len(results)))
+        self.stdout.write('Redelivered: {}'.format(redelivered))
+        self.stdout.write('Worker processes: {}'.format(len(workers)))
+        if short_waits:
+            self.stdout.write(
+                'Short task wait: median {:.1f}s, max {:.1f}s'.format(
+                    short_waits[len(short_waits) // 2], short_waits[-1]))
+            self.stdout.write(
+                'Short tasks that waited behind a long task: {}'.format(
+                    len(blocked)))
@@ -0,0 +1,39 @@
+"""
+Record a member's transfer for offline replay (see replay_transfer).
+
+The transfer runs as usual, but nothing is uploaded to Open Humans. Every
+Nightscout response is saved to the archive with sensitive fields already
+substituted.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from oh_data_source.models import OpenHumansMember
+from oh_data_source.recording import record_transfer
+
+
+class Command(BaseCommand):
+    help = "Record a member's Nightscout responses to a replay archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument('oh_id')
+        parser.add_argument('nightscout_url')
+        parser.add_argument('archive', help='Output file, e.g. slow.ns.gz')
+        parser.add_argument('--after', default='',
+                            help='Start date, YYYY-MM-DD.')
+        parser.add_argument('--before', default='',
+                            help='End date, YYYY-MM-DD (default: today).')
+        parser.add_argument('--daily-summary', action='store_true')
+
+    def handle(self, *args, **options):
+        try:
+            oh_member = OpenHumansMember.objects.get(oh_id=options['oh_id'])
+        except OpenHumansMember.DoesNotExist:
+            raise CommandError('No member {}.'.format(options['oh_id']))
+        count = record_transfer(
+            oh_member, options['nightscout_url'], options['archive'],
+            before_date=options['before'], after_date=options['after'],
+            daily_summary=options['daily_summary'])
+        if count is None:
+            raise CommandError('Nightscout site did not return 200 status.')
+        self.stdout.write('Recorded {} responses to {}'.format(
+            count, options['archive']))
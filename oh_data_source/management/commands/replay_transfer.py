@@ -0,0 +1,42 @@
+"""
+Replay a recorded transfer (see record_transfer) under a profiler.
+
+No network requests are made and nothing is uploaded. For each phase of the
+transfer, prints its wall time and the functions with the most self time,
+and with --out-dir writes the phase's profile: a .prof file for
+cProfile (pstats, snakeviz) or a .folded stack file for the sampling
+profiler (flamegraph.pl, speedscope).
+"""
+from django.core.management.base import BaseCommand
+
+from oh_data_source.recording import PROFILERS, replay_transfer
+
+
+class Command(BaseCommand):
+    help = 'Replay a recorded transfer and profile each phase.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('archive')
+        parser.add_argument('--profiler', choices=sorted(PROFILERS),
+                            default='cprofile')
+        parser.add_argument('--out-dir', default=None,
+                            help='Directory for per-phase profile files.')
+        parser.add_argument('--top', type=int, default=10,
+                            help='Functions to list per phase.')
+
+    def handle(self, *args, **options):
+        member, replayer = replay_transfer(
+            options['archive'], profiler=options['profiler'],
+            out_dir=options['out_dir'])
+        total = sum(result['seconds'] for result in member.phases.values())
+        for phase, result in member.phases.items():
+            self.stdout.write('{}: {:.2f}s ({:.0f}%)'.format(
+                phase, result['seconds'],
+                100 * result['seconds'] / total if total else 0))
+            for function, fraction in result['profiler'].top(options['top']):
+                self.stdout.write('  {:5.1f}%  {}'.format(
+                    100 * fraction, function))
+        if replayer.misses:
+            self.stdout.write(
+                '{} requests were not in the recording and got empty '
+                'responses.'.format(replayer.misses))
@@ -4,13 +4,17 @@ import os
 import arrow
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.cache import cache
+from django.db import connection, models, transaction
 from django.utils.encoding import python_2_unicode_compatible
 import requests
 
 OH_CLIENT_ID = os.getenv('OH_CLIENT_ID', '')
 OH_CLIENT_SECRET = os.getenv('OH_CLIENT_SECRET', '')
 
+# Seconds to keep published transfer progress after its last update.
+XFER_PROGRESS_CACHE_TTL = 24 * 60 * 60
+
 
 def make_unique_username(base):
     """
@@ -67,30 +71,98 @@ class OpenHumansMember(models.Model):
         return "<OpenHumansMember(oh_id='{}')>".format(
             self.oh_id)
 
-    def get_access_token(self):
+    def member_data_cache_key(self):
+        """
+        Return the cache key for this member's Open Humans member data.
+        """
+        return 'oh-member-data-{}'.format(self.oh_id)
+
+    def clear_cached_member_data(self):
+        """
+        Drop cached member data, e.g. after files or tokens change.
+        """
+        cache.delete(self.member_data_cache_key())
+
+    def xfer_progress_cache_key(self):
+        """
+        Return the cache key for this member's transfer progress.
+        """
+        return 'xfer-progress-{}'.format(self.oh_id)
+
+    def set_xfer_status(self, status, **progress):
+        """
+        Save transfer status and publish it for status polling.
+
+        Keyword arguments (e.g. data_type, percent, records) are published
+        along with the status, but not saved to the database.
+        """
+        self.last_xfer_status = status
+        self.save(update_fields=['last_xfer_status'])
+        progress.update({'status': status, 'updated': arrow.get().isoformat()})
+        cache.set(self.xfer_progress_cache_key(), progress,
+                  XFER_PROGRESS_CACHE_TTL)
+        if settings.XFER_STATUS_CLOSE_DB:
+            connection.close()
+
+    def get_xfer_progress(self):
+        """
+        Return the latest published transfer progress as a dict.
+
+        Falls back to the saved status if nothing is published.
+        """
+        progress = cache.get(self.xfer_progress_cache_key())
+        if progress is None:
+            progress = {'status': self.last_xfer_status}
+        if self.last_xfer_datetime:
+            progress['initiated'] = arrow.get(
+                self.last_xfer_datetime).isoformat()
+        return progress
+
+    def get_access_token(self, min_valid=60):
         """
         Return access token. Refresh first if necessary.
+
+        The token is refreshed if it expires within min_valid seconds, so
+        callers about to do long work (e.g. uploads) can refresh up front.
         """
-        # Also refresh if nearly expired (less than 60s remaining).
-        delta = timedelta(seconds=60)
-        if arrow.get(self.token_expires) - delta < arrow.now():
-            self._refresh_tokens()
+        if self._token_expires_within(min_valid):
+            self._refresh_tokens(min_valid)
         return self.access_token
 
-    def _refresh_tokens(self):
+    def _token_expires_within(self, seconds):
+        delta = timedelta(seconds=seconds)
+        return arrow.get(self.token_expires) - delta < arrow.now()
+
+    def _refresh_tokens(self, min_valid=60):
         """
         Refresh access token.
+
+        Each refresh token can only be used once, so the member's row is
+        locked while refreshing. A task or view that waited for the lock
+        picks up the token another one just obtained instead of spending the
+        now-invalid refresh token again.
         """
-        response = requests.post(
-            'https://www.openhumans.org/oauth2/token/',
-            data={
-                'grant_type': 'refresh_token',
-                'refresh_token': self.refresh_token},
-            auth=requests.auth.HTTPBasicAuth(
-                settings.OH_CLIENT_ID, settings.OH_CLIENT_SECRET))
+        with transaction.atomic():
+            current = OpenHumansMember.objects.select_for_update().get(
+                pk=self.pk)
+            self.access_token = current.access_token
+            self.refresh_token = current.refresh_token
+            self.token_expires = current.token_expires
+            if not self._token_expires_within(min_valid):
+                return
+            response = requests.post(
+                'https://www.openhumans.org/oauth2/token/',
+                data={
+                    'grant_type': 'refresh_token',
+                    'refresh_token': self.refresh_token},
+                auth=requests.auth.HTTPBasicAuth(
+                    settings.OH_CLIENT_ID, settings.OH_CLIENT_SECRET))
+            if response.status_code == 200:
+                data = response.json()
+                self.access_token = data['access_token']
+                self.refresh_token = data['refresh_token']
+                self.token_expires = self.get_expiration(data['expires_in'])
+                self.save(update_fields=[
+                    'access_token', 'refresh_token', 'token_expires'])
         if response.status_code == 200:
-            data = response.json()
-            self.access_token = data['access_token']
-            self.refresh_token = data['refresh_token']
-            self.token_expires = self.get_expiration(data['expires_in'])
-            self.save()
+            self.clear_cached_member_data()
@@ -9,319 +9,791 @@ import string
 from urlparse import urlparse
 
 import arrow
+from django.core.cache import cache
+from django.utils.crypto import salted_hmac
 import requests
 
+from . import response_cache
+from .crawl_engine import get_engine
+from .records import parse_compact_records
+from .writers import IndexedEntriesWriter, JSONArrayWriter
+
 MAX_RETRIES = 4
 
+# Seconds to wait for a Nightscout server to respond before retrying.
+REQUEST_TIMEOUT = int(os.getenv('NS_REQUEST_TIMEOUT', '60'))
+
+# Larger responses are abandoned, and their query window split in two.
+MAX_RESPONSE_BYTES = int(os.getenv('NS_MAX_RESPONSE_MB', '50')) * 1024 * 1024
+
+# Windows aren't split or narrowed below this width.
+MIN_WINDOW = datetime.timedelta(minutes=10)
+
+# Numeric (epoch milliseconds) time fields to look for, in order.
+NUMERIC_TIME_FIELDS = ('date', 'mills')
+
+# How far an ISO 'created_at' string, compared as a string, may be from the
+# item's time: the largest timezone offset.
+ISO_TIME_MARGIN = datetime.timedelta(hours=14)
+
+# How far out of time order items sorted by their 'created_at' strings may
+# be: the spread of timezone offsets, from -12:00 to +14:00.
+ISO_ORDER_MARGIN = datetime.timedelta(hours=26)
+
+# How long to cache what probe_ns_site learns about a Nightscout host.
+PROBE_CACHE_TTL = int(os.getenv('NS_PROBE_CACHE_TTL', '3600'))
+
+# Profile fields that differ between stored copies of the same profile.
+PROFILE_VOLATILE_FIELDS = ('_id', 'created_at', 'startDate', 'mills',
+                           'srvCreated', 'srvModified', 'identifier')
+
+# Open Humans tag of profile index files (see profile_data_files).
+PROFILE_INDEX_TAG = 'profile-index'
+
 # Set up logging.
 logger = logging.getLogger(__name__)
 
 
-def log_update(oh_member, update_msg):
+class ResponseTooLarge(Exception):
+    """
+    A Nightscout response was larger than MAX_RESPONSE_BYTES.
+    """
+
+
+def log_update(oh_member, update_msg, **progress):
     logger.debug(update_msg)
-    oh_member.last_xfer_status = update_msg + ' ({})'.format(
-        arrow.get().format())
-    oh_member.save()
+    oh_member.set_xfer_status(
+        update_msg + ' ({})'.format(arrow.get().format()), **progress)
 
 
-def normalize_url(url_input):
+def sub_sensitive(targ_dict, subs_dict, keyval):
     """
-    Return URL with scheme + netloc only, e.g. 'https://www.example.com'.
+    Sub potentially sensitive keyval in targ_dict w/random string in subs_dict
 
-    If no scheme is specified, try https, fall back to http.
-    Return None if a GET to the normalized URL doesn't return a 200 status.
+    Unhashable values (e.g. a dict) are looked up by their JSON encoding.
     """
-    if not url_input.startswith('http'):
-        url_input = 'https://' + url_input
-    parsed = urlparse(url_input)
-    url = parsed.scheme + '://' + parsed.netloc
     try:
-        test_url = requests.get(url)
-    except requests.exceptions.SSLError:
-        url = 'http://' + parsed.netloc
-        test_url = requests.get(url)
-    if test_url.status_code != 200:
-        return None
-    return url
+        value = targ_dict[keyval]
+    except KeyError:
+        return
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, sort_keys=True)
+    if value not in subs_dict:
+        subs_dict[value] = ''.join(random.choice(
+            string.ascii_uppercase + string.digits) for _ in range(6))
+    targ_dict[keyval] = subs_dict[value]
+
+
+# Per-collection crawl settings: the size of each query window, the earliest
+# date searched back to, how many windows' width of empty windows in a row
+# end the crawl, the potentially sensitive key to substitute in each item,
+# the numeric time field to query on (None: detect per site), and optionally
+# how to parse responses (default: json.loads).
+COLLECTIONS = {
+    'entries': {
+        'window': datetime.timedelta(milliseconds=5000000000),
+        'floor': '2010-01-01',
+        'max_empty_run': 6,
+        'sensitive_key': None,
+        'time_field': 'date',
+    },
+    'treatments': {
+        'window': datetime.timedelta(days=20),
+        'floor': '2012-01-01',
+        'max_empty_run': 15,
+        'sensitive_key': 'enteredBy',
+        'time_field': None,
+    },
+    'devicestatus': {
+        'window': datetime.timedelta(days=2),
+        'floor': '2014-10-01',
+        'max_empty_run': 40,
+        'sensitive_key': 'device',
+        'time_field': None,
+        # Items are large and nested: keep them compact while in memory.
+        'parse': parse_compact_records,
+    },
+}
+
+
+# If set, a callable(url, params) that ns_get uses to get response content
+# instead of ns_fetch. See set_transport and recording.py.
+_transport = None
+
+
+def set_transport(transport):
+    """
+    Make ns_get get response content from transport; None restores ns_fetch.
+    """
+    global _transport
+    _transport = transport
 
 
-def sub_sensitive(targ_dict, subs_dict, keyval):
+def ns_get(url, params, parse=json.loads):
     """
-    Sub potentially sensitive keyval in targ_dict w/random string in subs_dict
+    GET a Nightscout API URL and return the response parsed with parse.
     """
-    try:
-        targ_dict[keyval] = subs_dict[targ_dict[keyval]]
-    except KeyError:
+    return parse((_transport or ns_fetch)(url, params))
+
+
+def ns_fetch(url, params):
+    """
+    GET a Nightscout API URL and return the response content.
+
+    Non-200 responses, timeouts and connection errors are retried up to
+    MAX_RETRIES times. Responses larger than MAX_RESPONSE_BYTES raise
+    ResponseTooLarge. Responses are served from and saved to the response
+    cache, if it's enabled.
+    """
+    content = response_cache.get(url, params)
+    if content is not None:
+        logger.debug('Response cache hit.')
+        return content
+    retries = 0
+    while True:
         try:
-            subs_dict[targ_dict[keyval]] = ''.join(random.choice(
-                string.ascii_uppercase + string.digits) for _ in range(6))
-            targ_dict[keyval] = subs_dict[targ_dict[keyval]]
-        except KeyError:
-            pass
+            req = requests.get(url, params=params, timeout=REQUEST_TIMEOUT,
+                               stream=True)
+            logger.debug('Request complete.')
+            if req.status_code == 200:
+                content = read_limited(req, MAX_RESPONSE_BYTES)
+                response_cache.put(url, params, content)
+                return content
+            req.close()
+            error = 'Status code is {}'.format(req.status_code)
+        except (requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as e:
+            error = e
+        assert retries < MAX_RETRIES, 'NS URL != 200 status'
+        retries += 1
+        logger.debug("RETRY {}: {}".format(retries, error))
+
+
+def read_limited(req, max_bytes):
+    """
+    Return the content of a streamed response, or raise ResponseTooLarge.
+    """
+    try:
+        if int(req.headers.get('Content-Length', 0)) > max_bytes:
+            raise ResponseTooLarge()
+        chunks = []
+        size = 0
+        for chunk in req.iter_content(64 * 1024):
+            size += len(chunk)
+            if size > max_bytes:
+                raise ResponseTooLarge()
+            chunks.append(chunk)
+        return b''.join(chunks)
+    finally:
+        req.close()
+
+
+def get_time_field(collection, time_field=None):
+    """
+    Return the field a collection is queried by time on.
+
+    time_field is the field detected for the site (see detect_time_field),
+    if any. Without one, collections fall back to their ISO 'created_at'.
+    """
+    return time_field or COLLECTIONS[collection]['time_field'] or 'created_at'
 
 
-def get_ns_entries(oh_member, ns_url, file_obj, before_date, after_date):
+def time_filter(collection, op, time, time_field=None):
     """
-    Get Nightscout entries data, ~60 days at a time.
+    Return a (param, value) find filter comparing a collection's time field.
 
-    Retrieve ~60 days at a time until either (a) the start point is reached
-    (after_date parameter) or (b) a run of 6 empty calls or (c) Jan 2010.
+    Numeric fields hold milliseconds since the epoch; 'created_at' holds ISO
+    8601 strings, which the server compares as strings.
     """
-    end = arrow.get(before_date).ceil('second').timestamp * 1000
-    start = arrow.get('2010-01-01').floor('second').timestamp * 1000
-    if after_date:
-        start = arrow.get(after_date).floor('second').timestamp * 1000
+    field = get_time_field(collection, time_field)
+    if field == 'created_at':
+        return 'find[created_at][${}]'.format(op), time.to('utc').isoformat()
+    # Arrow's timestamp is whole seconds: keep the milliseconds.
+    return 'find[{}][${}]'.format(field, op), (
+        time.timestamp * 1000 + time.microsecond // 1000)
 
-    ns_entries_url = ns_url + '/api/v1/entries.json'
 
-    # Start a JSON array.
-    file_obj.write('[')
-    initial_entry_done = False  # Entries after initial are preceded by commas.
+def time_margin(collection, time_field=None):
+    """
+    Return how far a collection's crawl must be widened at each end.
+
+    The server compares 'created_at' as strings. Adjacent windows share their
+    boundary strings, so each item is still returned by exactly one window,
+    but an item stored with another timezone offset may be returned by a
+    window up to ISO_TIME_MARGIN away from its time. So the crawl's newest
+    and oldest windows are widened by ISO_TIME_MARGIN, and items outside the
+    crawl's time range are dropped (see in_window).
+    """
+    if get_time_field(collection, time_field) == 'created_at':
+        return ISO_TIME_MARGIN
+    return datetime.timedelta(0)
 
-    # Get 8 million second chunks (~ 1/4th year) until none, or start reached.
-    complete = False
-    curr_end = end
-    curr_start = curr_end - 5000000000
-    empty_run = 0
-    retries = 0
-    while not complete:
-        if curr_start < start:
-            curr_start = start
-            complete = True
-            logger.debug('Final round (starting date reached)...')
-        log_update(oh_member, 'Querying entries from {} to {}...'.format(
-            arrow.get(curr_start/1000).format(),
-            arrow.get(curr_end/1000).format()))
-        ns_params = {'count': 1000000}
-        ns_params['find[date][$lte]'] = curr_end
-        ns_params['find[date][$gt]'] = curr_start
-        entries_req = requests.get(ns_entries_url, params=ns_params)
-        logger.debug('Request complete.')
-        assert entries_req.status_code == 200 or retries < MAX_RETRIES, \
-            'NS entries URL != 200 status'
-        if entries_req.status_code != 200:
-            retries +=1
-            logger.debug("RETRY {}: Status code is {}".format(
-                retries, entries_req.status_code))
-            continue
-        logger.debug('Status code 200.')
-        retries = 0
-        logger.debug('Retrieved {} entries...'.format(len(entries_req.json())))
-        if entries_req.json():
-            empty_run = 0
-            for entry in entries_req.json():
-                if initial_entry_done:
-                    file_obj.write(',')  # JSON array separator
-                else:
-                    initial_entry_done = True
-                json.dump(entry, file_obj)
-            logger.debug('Wrote {} entries to file...'.format(len(entries_req.json())))
-        else:
-            empty_run += 1
-            if empty_run > 6:
-                logger.debug('>10 empty calls: ceasing entries queries.')
-                break
-        curr_end = curr_start
-        curr_start = curr_end - 5000000000
 
-    file_obj.write(']')  # End of JSON array.
-    logger.debug('Done writing entries to file.')
+def window_params(collection, curr_start, curr_end, time_field=None):
+    """
+    Return query parameters selecting a collection's items in a time window.
+    """
+    ns_params = {'count': 1000000}
+    ns_params.update([
+        time_filter(collection, 'lte', curr_end, time_field),
+        time_filter(collection, 'gt', curr_start, time_field)])
+    return ns_params
 
 
-def get_ns_devicestatus(oh_member, ns_url, file_obj, before_date, after_date):
+def in_window(item, curr_start, curr_end):
     """
-    Get Nightscout devicestatus data, 2 days at a time.
+    Return True if an item's created_at is in (curr_start, curr_end].
 
-    Retrieve four days at a time until either (a) the start point is reached
-    (after_date parameter) or (b) a run of 40 empty calls or (c) Oct 2014.
+    Unreadable times are compared as strings, as the server would have
+    compared them in an unwidened query.
     """
-    end = arrow.get(before_date).ceil('second')
-    start = arrow.get('2014-10-01').floor('second')
-    if after_date:
-        start = arrow.get(after_date).floor('second')
+    try:
+        return curr_start < arrow.get(item['created_at']) <= curr_end
+    except KeyError:
+        return False
+    except (TypeError, ValueError, arrow.parser.ParserError):
+        return (curr_start.to('utc').isoformat() < item['created_at'] <=
+                curr_end.to('utc').isoformat())
 
-    # Dict for consistent subs of recurring potentially sensitive strings.
-    subs = dict()
 
-    ns_entries_url = ns_url + '/api/v1/devicestatus.json'
+def has_items_before(ns_url, collection, time, time_field=None):
+    """
+    Return True if a collection has any items before the given time.
+    """
+    ns_data_url = ns_url + '/api/v1/{}.json'.format(collection)
+    ns_params = {'count': 1}
+    ns_params.update([time_filter(collection, 'lt', time, time_field)])
+    return bool(ns_get(ns_data_url, ns_params))
 
-    # Start a JSON array.
-    file_obj.write('[')
-    initial_entry_done = False  # Entries after initial are preceded by commas.
 
-    # Get 8 million second chunks (~ 1/4th year) until none, or start reached.
-    complete = False
-    curr_end = end
-    curr_start = curr_end - datetime.timedelta(days=2)
-    empty_run = 0
-    retries = 0
-    while not complete:
-        if curr_start < start:
-            curr_start = start
-            complete = True
-            logger.debug('Final round (starting date reached)...')
-        log_update(oh_member, 'Querying devicestatus from {} to {}...'.format(
-            curr_start.isoformat(), curr_end.isoformat()))
-        ns_params = {'count': 1000000}
-        ns_params['find[created_at][$lte]'] = curr_end.isoformat()
-        ns_params['find[created_at][$gt]'] = curr_start.isoformat()
-        devicestatus_req = requests.get(ns_entries_url, params=ns_params)
-        logger.debug('Request complete.')
-        assert devicestatus_req.status_code == 200 or retries < MAX_RETRIES, \
-            'NS devicestatus URL != 200 status'
-        if devicestatus_req.status_code != 200:
-            retries += 1
-            logger.debug("RETRY {}: Status code is {}".format(
-                retries, devicestatus_req.status_code))
+def item_time(collection, item, time_field=None):
+    """
+    Return the time of a Nightscout item as an Arrow object, or None.
+    """
+    field = get_time_field(collection, time_field)
+    try:
+        if field == 'created_at':
+            return arrow.get(item['created_at'])
+        return arrow.get(item[field] / 1000.0)
+    except (KeyError, TypeError, ValueError, arrow.parser.ParserError):
+        return None
+
+
+def detect_time_field(ns_url, collection):
+    """
+    Return a numeric time field the site can query a collection on, or None.
+
+    A field in NUMERIC_TIME_FIELDS qualifies if the newest item has a number
+    in it, a query on it finds that item, and no items lack it. Otherwise
+    the collection is queried on 'created_at'.
+    """
+    if COLLECTIONS[collection]['time_field']:
+        return COLLECTIONS[collection]['time_field']
+    ns_data_url = ns_url + '/api/v1/{}.json'.format(collection)
+    newest = ns_get(ns_data_url, {'count': 1})
+    if not newest:
+        return None
+    for field in NUMERIC_TIME_FIELDS:
+        value = newest[0].get(field)
+        if not isinstance(value, (int, long, float)) or isinstance(
+                value, bool):
+            continue
+        # Values are sent as strings; check the server compares numbers.
+        found = ns_get(ns_data_url, {
+            'count': 1, 'find[{}][$gte]'.format(field): value})
+        if not found or found[0].get('_id') != newest[0].get('_id'):
+            continue
+        # A server that can't parse this filter returns items with the
+        # field, so only an empty result shows that no items lack it.
+        if ns_get(ns_data_url, {
+                'count': 1, 'find[{}][$exists]'.format(field): 'false'}):
             continue
-        logger.debug('Status code 200.')
-        retries = 0
-        logger.debug('Retrieved {} devicestatus items...'.format(
-            len(devicestatus_req.json())))
-        if devicestatus_req.json():
-            empty_run = 0
-            for item in devicestatus_req.json():
-                sub_sensitive(item, subs, 'device')
-                if initial_entry_done:
-                    file_obj.write(',')  # JSON array separator
-                else:
-                    initial_entry_done = True
-                json.dump(item, file_obj)
-            logger.debug('Wrote {} devicestatus items to file...'.format(
-                len(devicestatus_req.json())))
+        return field
+    return None
+
+
+def find_earliest_date(ns_url, collection, time_field=None):
+    """
+    Return the day of the first item in a collection, found by bisection.
+
+    Each step asks whether any items exist before the midpoint of the
+    remaining range (a cheap count=1 query), so finding the first day between
+    the collection's floor date and now takes about a dozen requests. If
+    there are no items, today's date is returned.
+    """
+    lo = arrow.get(COLLECTIONS[collection]['floor']).floor('day')
+    hi = arrow.get().ceil('day')
+    if not has_items_before(ns_url, collection, hi, time_field):
+        return arrow.get().format('YYYY-MM-DD')
+    while hi - lo > datetime.timedelta(days=1):
+        mid = lo + (hi - lo) / 2
+        if has_items_before(ns_url, collection, mid, time_field):
+            hi = mid
         else:
-            # Quit if more than 10 empty weeks have been encountered.
-            empty_run += 1
-            if empty_run > 40:
-                logger.debug('>10 empty weeks: ceasing devicestatus queries.')
-                break
-        curr_end = curr_start
-        curr_start = curr_end - datetime.timedelta(days=2)
+            lo = mid
+    return lo.format('YYYY-MM-DD')
 
-    file_obj.write(']')
-    logger.debug('Done writing devicestatus items to file.')
 
+def find_latest_time(ns_url, collection, before, time_field=None):
+    """
+    Return the time of the newest item in a collection up to before, or None.
 
-def get_ns_treatments(oh_member, ns_url, file_obj, before_date, after_date):
+    Nightscout returns the newest items first, so one count=1 query is
+    enough. If the item has no usable time, before is returned.
+
+    Only entries are sorted by the field they're queried on. Other
+    collections are sorted by their 'created_at' strings, so when they're
+    queried on a numeric time_field, items up to ISO_ORDER_MARGIN newer than
+    the first may follow it, and the time returned allows for them.
     """
-    Get Nightscout treatments data, 20 days at a time.
+    ns_data_url = ns_url + '/api/v1/{}.json'.format(collection)
+    ns_params = {'count': 1}
+    ns_params.update([time_filter(
+        collection, 'lte', before + time_margin(collection, time_field),
+        time_field)])
+    items = ns_get(ns_data_url, ns_params)
+    if not items:
+        return None
+    latest = item_time(collection, items[0], time_field)
+    if not latest:
+        return before
+    if get_time_field(collection, time_field) != get_time_field(collection):
+        latest += ISO_ORDER_MARGIN
+    return latest
 
-    Retrieve in chunks and write to file until (a) the start point is reached
-    (after_date parameter) or (b) a run of 15 empty calls or (c) Jan 2012.
+
+def probe_cache_key(netloc):
     """
-    end = arrow.get(before_date).ceil('second')
-    start = arrow.get('2012-01-01').floor('second')
-    if after_date:
-        start = arrow.get(after_date).floor('second')
+    Return a cache key for a Nightscout host that doesn't reveal the host.
+    """
+    return 'ns-probe-' + salted_hmac('ns-probe', netloc).hexdigest()
 
-    # Dict for consistent subs of recurring potentially sensitive strings.
-    subs = dict()
 
-    ns_entries_url = ns_url + '/api/v1/treatments.json'
+def probe_ns_site(url_input):
+    """
+    Return what's known about a Nightscout site, or None if it's unreachable.
+
+    If no scheme is specified, try https, fall back to http. The returned dict
+    has the normalized 'url' (scheme + netloc only), 'scheme', server
+    'version', and for each collection in COLLECTIONS
+    the numeric 'time_fields' it can be queried on (see detect_time_field)
+    and the 'earliest' date of data.
 
-    # Start a JSON array.
-    file_obj.write('[')
-    initial_entry_done = False  # Entries after initial are preceded by commas.
+    Results are cached per host for PROBE_CACHE_TTL seconds. The cache key is
+    an HMAC of the host and the URL itself isn't cached.
+    """
+    if not url_input.startswith('http'):
+        url_input = 'https://' + url_input
+    parsed = urlparse(url_input)
+    cache_key = probe_cache_key(parsed.netloc)
+    probe = cache.get(cache_key)
+    if probe is None:
+        scheme = parsed.scheme
+        try:
+            try:
+                status_req = requests.get(
+                    scheme + '://' + parsed.netloc + '/api/v1/status.json',
+                    timeout=REQUEST_TIMEOUT)
+            except requests.exceptions.SSLError:
+                scheme = 'http'
+                status_req = requests.get(
+                    scheme + '://' + parsed.netloc + '/api/v1/status.json',
+                    timeout=REQUEST_TIMEOUT)
+            if status_req.status_code != 200:
+                return None
+            status = status_req.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # Unreachable host, timeout, or a body that isn't JSON.
+            logger.info('Nightscout status request failed: {}'.format(
+                type(e).__name__))
+            return None
+        if not isinstance(status, dict):
+            return None
+        url = scheme + '://' + parsed.netloc
+        time_fields = dict((collection, detect_time_field(url, collection))
+                           for collection in COLLECTIONS)
+        probe = {
+            'scheme': scheme,
+            'version': status.get('version'),
+            'time_fields': time_fields,
+            'earliest': dict(
+                (collection, find_earliest_date(
+                    url, collection, time_fields[collection]))
+                for collection in COLLECTIONS),
+        }
+        cache.set(cache_key, probe, PROBE_CACHE_TTL)
+    return dict(probe, url=probe['scheme'] + '://' + parsed.netloc)
+
+
+def query_windows(start, end, width):
+    """
+    Yield (start, end) windows of the given width, from end back to start.
 
-    # Get 8 million second chunks (~ 1/4th year) until none, or start reached.
-    complete = False
+    width is a timedelta, or a function returning the width of the next
+    window.
+    """
     curr_end = end
-    curr_start = curr_end - datetime.timedelta(days=20)
-    empty_run = 0
-    retries = 0
-    while not complete:
-        if curr_start < start:
-            curr_start = start
-            complete = True
-            logger.debug('Final round (starting date reached)...')
-        log_update(oh_member, 'Querying treatments from {} to {}...'.format(
-            curr_start.isoformat(), curr_end.isoformat()))
-        ns_params = {'count': 1000000}
-        ns_params['find[created_at][$lte]'] = curr_end.isoformat()
-        ns_params['find[created_at][$gt]'] = curr_start.isoformat()
-        treatments_req = requests.get(ns_entries_url, params=ns_params)
-        logger.debug('Request complete.')
-        assert treatments_req.status_code == 200 or retries < MAX_RETRIES, \
-            'NS treatments URL != 200 status'
-        if treatments_req.status_code != 200:
-            retries += 1
-            logger.debug("RETRY {}: Status code is {}".format(
-                retries, treatments_req.status_code))
-            continue
-        logger.debug('Status code 200.')
-        retries = 0
-        logger.debug('Retrieved {} treatments items...'.format(
-            len(treatments_req.json())))
-        if treatments_req.json():
-            empty_run = 0
-            for item in treatments_req.json():
-                sub_sensitive(item, subs, 'enteredBy')
-                if initial_entry_done:
-                    file_obj.write(',')  # JSON array separator
-                else:
-                    initial_entry_done = True
-                json.dump(item, file_obj)
-            logger.debug('Wrote {} treatments items to file...'.format(
-                len(treatments_req.json())))
+    while curr_end > start:
+        curr_width = width() if callable(width) else width
+        curr_start = max(curr_end - curr_width, start)
+        yield curr_start, curr_end
+        curr_end = curr_start
+
+
+def crawl_collection(oh_member, ns_url, writer, collection,
+                     before_date, after_date, earliest=None, engine=None,
+                     on_items=None, budget=None, time_field=None,
+                     item_filter=None):
+    """
+    Crawl a Nightscout collection, passing each window's items to writer.
+
+    Query windows run from before_date back until either (a) the start point
+    is reached or (b) a run of empty windows spanning more than the
+    collection's max_empty_run windows (measured in time, as windows may be
+    narrowed). The start point is after_date or, if later, the earliest
+    date with data (see probe_ns_site), else the collection's floor date.
+    Windows after the newest item are skipped.
+
+    time_field is the numeric time field detected for the collection, if any
+    (see detect_time_field). Without one, the crawl queries on ISO
+    'created_at' strings, and its first and last windows are widened (see
+    time_margin).
+
+    If given, budget is the transfer's TransferBudget (see budget.py). Under
+    memory pressure windows are narrowed, and once it's exceeded the crawl
+    stops early and the collection is marked partial. Windows whose response
+    is too large are split in two.
+
+    If given, item_filter (e.g. an EntriesFilter, see filters.py) adds its
+    params() to each query and drops items with its apply().
+
+    writer is e.g. a JSONArrayWriter (see writers.py); its finish() is called
+    at the end. If given, on_items is also called with each window's items.
+    """
+    conf = COLLECTIONS[collection]
+    margin = time_margin(collection, time_field)
+    end = range_end = arrow.get(before_date).ceil('second')
+    start = range_start = arrow.get(
+        after_date or conf['floor']).floor('second')
+    if earliest:
+        start = max(start, arrow.get(earliest).floor('second'))
+    if budget and budget.exceeded():
+        budget.mark_partial(collection, end)
+        start = end
+    if start < end:
+        latest = find_latest_time(ns_url, collection, end, time_field)
+        end = min(end, latest.ceil('second')) if latest else start
+
+    # Dict for consistent subs of recurring potentially sensitive strings.
+    subs = dict()
+
+    ns_data_url = ns_url + '/api/v1/{}.json'.format(collection)
+    parse_items = conf.get('parse', json.loads)
+
+    def parse(content):
+        if budget:
+            budget.add_bytes(len(content))
+        return parse_items(content)
+
+    def fetch(window):
+        query_start, query_end = window
+        if margin:
+            # Only the crawl's outermost windows are widened.
+            if query_end == end:
+                query_end += margin
+            if query_start == start:
+                query_start -= margin
+        ns_params = window_params(collection, query_start, query_end,
+                                  time_field)
+        if item_filter:
+            ns_params.update(item_filter.params())
+        try:
+            items = ns_get(ns_data_url, ns_params, parse=parse)
+        except ResponseTooLarge:
+            curr_start, curr_end = window
+            if curr_end - curr_start <= MIN_WINDOW:
+                logger.info('Skipping {} window: response too large.'.format(
+                    collection))
+                if budget:
+                    budget.mark_partial(collection, curr_end)
+                return []
+            # Newest half first, to keep the crawl's order.
+            middle = curr_start + (curr_end - curr_start) / 2
+            return fetch((middle, curr_end)) + fetch((curr_start, middle))
+        if margin:
+            items = [item for item in items
+                     if in_window(item, range_start, range_end)]
+        return items
+
+    width = {'current': conf['window']}
+
+    engine = engine or get_engine()
+    # Measured in time, not windows, as windows may be narrowed.
+    empty_run = datetime.timedelta(0)
+    max_empty_run = conf['max_empty_run'] * conf['window']
+    retrieved = 0
+    span = (end - start).total_seconds()
+    windows = query_windows(start, end, lambda: width['current'])
+    for (curr_start, curr_end), items in engine.map(fetch, windows):
+        if item_filter:
+            items = item_filter.apply(items)
+        retrieved += len(items)
+        log_update(
+            oh_member, 'Retrieved {} {} items from {} to {}...'.format(
+                len(items), collection, curr_start.format(), curr_end.format()),
+            data_type=collection, records=retrieved,
+            percent=int(100 * (end - curr_start).total_seconds() / span))
+        if items:
+            empty_run = datetime.timedelta(0)
+            if conf['sensitive_key']:
+                for item in items:
+                    sub_sensitive(item, subs, conf['sensitive_key'])
+            if on_items:
+                on_items(items)
+            writer.write_items(items)
+            logger.debug('Wrote {} {} items to file...'.format(
+                len(items), collection))
         else:
-            # Quit if more than 10 empty weeks have been encountered.
-            empty_run += 1
-            if empty_run > 15:
-                logger.debug('>15 empty calls: ceasing treatments queries.')
+            empty_run += curr_end - curr_start
+            if empty_run > max_empty_run:
+                logger.debug('>{} empty calls: ceasing {} queries.'.format(
+                    conf['max_empty_run'], collection))
                 break
-        curr_end = curr_start
-        curr_start = curr_end - datetime.timedelta(days=20)
+        del items
+
+        if budget:
+            if budget.exceeded():
+                budget.mark_partial(collection, curr_start)
+                break
+            if budget.memory_pressure() and width['current'] > MIN_WINDOW:
+                width['current'] = max(width['current'] / 2, MIN_WINDOW)
+                logger.info('Memory pressure: {} windows narrowed.'.format(
+                    collection))
+
+    writer.finish()
+    logger.debug('Done writing {} items to file.'.format(collection))
 
-    file_obj.write(']')
-    logger.debug('Done writing treatments items to file.')
+
+def get_ns_devicestatus(oh_member, ns_url, file_obj, before_date, after_date,
+                        earliest=None, on_items=None, budget=None,
+                        time_field=None):
+    """
+    Write Nightscout devicestatus data to file_obj as a JSON array.
+
+    Queries are 2 days wide (see COLLECTIONS). Where the crawl starts and
+    stops is described in crawl_collection.
+    """
+    crawl_collection(oh_member, ns_url, JSONArrayWriter(file_obj),
+                     'devicestatus', before_date, after_date, earliest,
+                     on_items=on_items, budget=budget, time_field=time_field)
+
+
+def get_ns_treatments(oh_member, ns_url, file_obj, before_date, after_date,
+                      earliest=None, on_items=None, budget=None,
+                      time_field=None):
+    """
+    Write Nightscout treatments data to file_obj as a JSON array.
+
+    Queries are 20 days wide (see COLLECTIONS). Where the crawl starts and
+    stops is described in crawl_collection.
+    """
+    crawl_collection(oh_member, ns_url, JSONArrayWriter(file_obj),
+                     'treatments', before_date, after_date, earliest,
+                     on_items=on_items, budget=budget, time_field=time_field)
 
 
 def ns_data_file(oh_member, data_type, tempdir, ns_url,
-                 before_date, after_date):
+                 before_date, after_date, earliest=None, on_items=None,
+                 budget=None, time_field=None, item_filter=None):
     """
     Retrieve data from a Nightscout URL, before and after dates.
 
+    If known, earliest is the date of the first data for this data type.
+    If given, on_items is called with each window of crawled items, budget
+    is the transfer's TransferBudget, and time_field is the numeric field to
+    query by time (see detect_time_field). For entries, item_filter is an
+    optional EntriesFilter (see filters.py).
     Return path to file and metadata, to be loaded in Open Humans.
     """
-    assert data_type in ['treatments', 'profile', 'entries', 'devicestatus']
+    assert data_type in ['treatments', 'entries', 'devicestatus']
 
     logger.debug('Initializing {}.json.gz file...'.format(data_type))
     filepath = os.path.join(tempdir, '{}'.format(data_type) + '_' + after_date + '_to_' + before_date + '.json.gz')
-    file_obj = gzip.open(filepath, 'wb')
 
     logger.info('Retrieving NS {} for {}...'.format(
         data_type, oh_member.oh_id))
 
-    # A single query works for sparse data.
-    if data_type == 'profile':
-        oh_member.last_xfer_status = 'Retrieving profile data... ({})'.format(
-            arrow.get().format())
-        oh_member.save()
-        ns_data_url = ns_url + '/api/v1/profile.json'
-        ns_params = {'count': 1000000}
-        data_req = requests.get(ns_data_url, params=ns_params)
-        if data_req.json():
-            json.dump(data_req.json(), file_obj)
-    elif data_type == 'treatments':
-        oh_member.last_xfer_status = 'Retrieving treatments data... ({})'.format(
-            arrow.get().format())
-        oh_member.save()
-        oh_member.last_xfer_status = 'Retrieving treatment data...'
-        get_ns_treatments(oh_member, ns_url, file_obj, before_date, after_date)
-    elif data_type == 'entries':
-        oh_member.last_xfer_status = 'Retrieving entries data... ({})'.format(
-            arrow.get().format())
-        oh_member.save()
-        get_ns_entries(oh_member, ns_url, file_obj, before_date, after_date)
+    log_update(oh_member, 'Retrieving {} data...'.format(data_type),
+               data_type=data_type, percent=0, records=0)
+
+    # Entries are written oldest first, with a sidecar index.
+    if data_type == 'entries':
+        writer = IndexedEntriesWriter(filepath, entries_index_path(filepath))
+        crawl_collection(oh_member, ns_url, writer, 'entries', before_date,
+                         after_date, earliest, on_items=on_items,
+                         budget=budget, time_field=time_field,
+                         item_filter=item_filter)
+        metadata = file_metadata(filepath, before_date, after_date)
+        metadata['description'] = 'Nightscout entries data'
+        if item_filter:
+            logger.info('Entries filter: {}'.format(item_filter.describe()))
+            metadata['tags'].append('filtered')
+            metadata['description'] += ' ({})'.format(item_filter.describe())
+        label_partial(metadata, data_type, budget)
+        return (filepath, metadata)
+
+    file_obj = gzip.open(filepath, 'wb')
+
+    if data_type == 'treatments':
+        get_ns_treatments(oh_member, ns_url, file_obj, before_date, after_date,
+                          earliest, on_items, budget, time_field)
     elif data_type == 'devicestatus':
-        oh_member.last_xfer_status = 'Retrieving devicestatus data... ({})'.format(
-            arrow.get().format())
-        oh_member.save()
-        get_ns_devicestatus(oh_member, ns_url, file_obj, before_date, after_date)
+        get_ns_devicestatus(oh_member, ns_url, file_obj, before_date, after_date,
+                            earliest, on_items, budget, time_field)
 
     logger.debug('Closing {}.json.gz file...'.format(data_type))
     file_obj.close()
 
+    metadata = file_metadata(filepath, before_date, after_date)
+    metadata['description'] = 'Nightscout {} data'.format(data_type)
+    label_partial(metadata, data_type, budget)
+    return (filepath, metadata)
+
+
+def label_partial(metadata, data_type, budget):
+    """
+    Tag and describe a file as partial if its data type wasn't completed.
+    """
+    if budget is None or data_type not in budget.partial:
+        return
+    metadata['tags'].append('partial')
+    metadata['description'] += (
+        ' (partial: {}; complete back to {})'.format(
+            budget.partial_reason(),
+            budget.partial[data_type].format()))
+
+
+def profile_hash(profile):
+    """
+    Return a hash of a profile's content, ignoring PROFILE_VOLATILE_FIELDS.
+    """
+    content = dict((key, value) for key, value in profile.items()
+                   if key not in PROFILE_VOLATILE_FIELDS)
+    return hashlib.sha1(
+        json.dumps(content, sort_keys=True, separators=(',', ':'))
+    ).hexdigest()
+
+
+def profile_data_files(oh_member, tempdir, ns_url, before_date, after_date,
+                       previous_index=None):
+    """
+    Retrieve Nightscout profiles, keeping only versions not uploaded before.
+
+    Nightscout stores a new profile document on every save, so most are
+    copies of earlier ones. Each document is identified by profile_hash, and
+    only versions whose hash isn't in previous_index (the last index
+    uploaded, if any) are written to a new versions file. The index lists
+    every document, oldest first, with its hash, and the versions file that
+    holds each hash.
+
+    Return a list of (path, metadata) to be loaded in Open Humans: the new
+    versions file, if there are new versions, and the index, if it changed.
+    """
+    log_update(oh_member, 'Retrieving profile data...',
+               data_type='profile', percent=0, records=0)
+
+    # A single query works for sparse data.
+    ns_data_url = ns_url + '/api/v1/profile.json'
+    profiles = ns_get(ns_data_url, {'count': 1000000})
+
+    if not previous_index:
+        previous_index = {'versions': {}, 'documents': []}
+    versions_filename = 'profile_versions_{}.json.gz'.format(
+        arrow.get().format('YYYYMMDDHHmmss'))
+    versions = dict(previous_index['versions'])
+    new_versions = []
+    documents = []
+    # Nightscout returns the newest first.
+    for profile in reversed(profiles):
+        digest = profile_hash(profile)
+        if digest not in versions:
+            versions[digest] = {'file': versions_filename}
+            new_versions.append(profile)
+        documents.append({
+            '_id': profile.get('_id'),
+            'created_at': profile.get('created_at'),
+            'startDate': profile.get('startDate'),
+            'hash': digest,
+        })
+    index = {'versions': versions, 'documents': documents}
+    logger.debug('{} profiles, {} new versions.'.format(
+        len(documents), len(new_versions)))
+
+    data_files = []
+    if new_versions:
+        filepath = os.path.join(tempdir, versions_filename)
+        with gzip.open(filepath, 'wb') as file_obj:
+            json.dump(new_versions, file_obj)
+        metadata = file_metadata(filepath, before_date, after_date)
+        metadata['tags'].append('profile')
+        metadata['description'] = (
+            'Nightscout profile versions not in earlier profile files')
+        data_files.append((filepath, metadata))
+    if index != previous_index:
+        filepath = os.path.join(tempdir, 'profile_index.json')
+        with open(filepath, 'w') as file_obj:
+            json.dump(index, file_obj, sort_keys=True)
+        metadata = file_metadata(filepath, before_date, after_date)
+        metadata['tags'].append(PROFILE_INDEX_TAG)
+        metadata['description'] = (
+            'Index of Nightscout profile documents, and the file holding '
+            'each profile version')
+        data_files.append((filepath, metadata))
+    return data_files
+
+
+def entries_index_path(entries_filepath):
+    """
+    Return the path of the sidecar index for an entries file.
+    """
+    return entries_filepath.replace('.json.gz', '.index.json')
+
+
+def entries_index_data_file(entries_filepath, before_date, after_date):
+    """
+    Return path and metadata for the index of an entries file from
+    ns_data_file, to be loaded in Open Humans.
+    """
+    filepath = entries_index_path(entries_filepath)
+    metadata = file_metadata(filepath, before_date, after_date)
+    metadata['tags'].append('index')
+    metadata['description'] = (
+        'Index of Nightscout entries blocks: time range, byte offset and '
+        'length of each gzip member, and sensor gaps')
+    return (filepath, metadata)
+
+
+def summary_data_file(summary, tempdir, before_date, after_date):
+    """
+    Write a DailySummary to a file in tempdir.
+
+    Return path to file and metadata, to be loaded in Open Humans.
+    """
+    filepath = os.path.join(tempdir, 'daily_summary_{}_to_{}.json'.format(
+        after_date, before_date))
+    with open(filepath, 'w') as file_obj:
+        summary.write(file_obj)
+    metadata = file_metadata(filepath, before_date, after_date)
+    metadata['tags'].append('summary')
+    metadata['description'] = 'Daily summary of Nightscout data'
+    return (filepath, metadata)
+
+
+def file_metadata(filepath, before_date, after_date):
+    """
+    Return Open Humans metadata for a file covering the given dates.
+    """
     md5 = hashlib.md5()
     with open(filepath, 'rb') as f:
         for chunk in iter(lambda: f.read(4096), b""):
@@ -330,11 +802,10 @@ def ns_data_file(oh_member, data_type, tempdir, ns_url,
 
     metadata = {
         'tags': ['json'],
-        'description': 'Nightscout {} data'.format(data_type),
         'md5': md5_hex,
         'end_date': arrow.get(before_date).format('YYYY-MM-DD'),
     }
     if after_date:
         metadata['start_date'] = arrow.get(after_date).format('YYYY-MM-DD')
 
-    return (filepath, metadata)
+    return metadata
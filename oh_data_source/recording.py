@@ -0,0 +1,302 @@
+"""
+Record one transfer's Nightscout responses, and replay them under a profiler.
+
+record_transfer() runs a transfer without uploading anything, saving every
+Nightscout response to a gzipped archive. Each collection's sensitive key
+(see COLLECTIONS) is substituted before the response is saved, and requests
+are stored by path and parameters only, so the archive doesn't contain the
+site's address.
+
+replay_transfer() runs add_data_to_open_humans() against an archive, with
+no network access, and profiles each phase of the transfer (probe, entries,
+treatments, devicestatus, profile) separately. Phases are tracked through
+the transfer's status updates. Only the thread running the transfer is
+profiled, so use the sync crawl engine (NS_CRAWL_ENGINE=sync) for replays.
+
+Archive format: a header line (JSON: dates, and the site probe without its
+URL), then one line per response: the request key (JSON), a tab, and the
+response body on one line.
+"""
+from __future__ import division
+
+import cProfile
+import gzip
+import json
+import logging
+import os
+import pstats
+import shutil
+import signal
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from urllib import urlencode
+from urlparse import urlparse
+
+import arrow
+from django.core.cache import cache
+
+from .nightscout_data import (COLLECTIONS, ns_fetch, probe_cache_key,
+                              probe_ns_site, set_transport, sub_sensitive)
+from .tasks import add_data_to_open_humans
+
+ARCHIVE_VERSION = 1
+
+# Stands in for the recorded site's host during a replay.
+REPLAY_HOST = 'replay.invalid'
+
+# Seconds between samples for the sampling profiler.
+SAMPLE_INTERVAL = 0.005
+
+# Set up logging.
+logger = logging.getLogger(__name__)
+
+
+def request_key(url, params):
+    """
+    Return a string identifying a request by its path and parameters.
+    """
+    return urlparse(url).path + '?' + urlencode(sorted(params.items()))
+
+
+class Recorder(object):
+    """
+    A transport for set_transport() that saves each response to an archive.
+    """
+    def __init__(self, archive_path, header):
+        self.archive = gzip.open(archive_path, 'wb')
+        self.archive.write(json.dumps(header) + '\n')
+        self.subs = dict()
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, url, params):
+        content = ns_fetch(url, params)
+        collection = os.path.basename(urlparse(url).path)[:-len('.json')]
+        sensitive_key = COLLECTIONS.get(collection, {}).get('sensitive_key')
+        # Crawl engines may fetch from several threads.
+        with self.lock:
+            items = json.loads(content)
+            if sensitive_key:
+                for item in items:
+                    sub_sensitive(item, self.subs, sensitive_key)
+            # json.dumps escapes newlines, so each body is one line.
+            content = json.dumps(items, separators=(',', ':'))
+            self.archive.write(
+                json.dumps(request_key(url, params)) + '\t' + content + '\n')
+            self.count += 1
+        return content
+
+    def close(self):
+        self.archive.close()
+
+
+class Replayer(object):
+    """
+    A transport for set_transport() that serves responses from an archive.
+
+    Requests that weren't recorded (e.g. windows a concurrent engine fetched
+    ahead) get an empty response, and are counted in misses.
+    """
+    def __init__(self, archive_path):
+        self.responses = {}
+        self.misses = 0
+        with gzip.open(archive_path, 'rb') as archive:
+            self.header = json.loads(archive.readline())
+            for line in archive:
+                key, content = line.rstrip('\n').split('\t', 1)
+                self.responses[json.loads(key)] = content
+
+    def __call__(self, url, params):
+        try:
+            return self.responses[request_key(url, params)]
+        except KeyError:
+            self.misses += 1
+            return '[]'
+
+
+def record_transfer(oh_member, ns_url, archive_path, before_date='',
+                    after_date='', daily_summary=False):
+    """
+    Run a transfer for oh_member without uploading, recording responses.
+
+    Return the number of responses recorded, or None if the site is
+    unreachable.
+    """
+    probe = probe_ns_site(ns_url)
+    if not probe:
+        return None
+    # Fix the dates, so a replay on a later day makes the same requests.
+    before_date = before_date or arrow.get().format('YYYY-MM-DD')
+    probe.pop('url')
+    recorder = Recorder(archive_path, {
+        'version': ARCHIVE_VERSION,
+        'recorded': arrow.get().isoformat(),
+        'before_date': before_date,
+        'after_date': after_date,
+        'daily_summary': daily_summary,
+        'probe': probe,
+    })
+    tempdir = tempfile.mkdtemp()
+    set_transport(recorder)
+    try:
+        add_data_to_open_humans(oh_member, before_date, after_date, ns_url,
+                                tempdir, daily_summary=daily_summary,
+                                upload=False)
+    finally:
+        set_transport(None)
+        recorder.close()
+        shutil.rmtree(tempdir)
+    return recorder.count
+
+
+class StackSampler(object):
+    """
+    A sampling profiler: counts the main thread's stacks every interval.
+
+    Uses SIGPROF, so it only works on Unix, and only in the main thread.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{}:{}'.format(
+                os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def enable(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+    def dump(self, filepath):
+        """
+        Write the stacks in the "folded" format read by flamegraph.pl and
+        speedscope.
+        """
+        with open(filepath, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+    def top(self, limit):
+        """
+        Return [(function, fraction of samples)] by self (leaf) samples.
+        """
+        total = sum(self.stacks.values())
+        if not total:
+            return []
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return [(function, count / total)
+                for function, count in leaves.most_common(limit)]
+
+
+class CProfiler(object):
+    """
+    cProfile, with the same interface as StackSampler.
+    """
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def enable(self):
+        self.profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+
+    def dump(self, filepath):
+        self.profile.dump_stats(filepath)
+
+    def top(self, limit):
+        """
+        Return [(function, fraction of time)] by self time.
+        """
+        stats = pstats.Stats(self.profile).stats
+        total = sum(tottime for _, _, tottime, _, _ in stats.values())
+        functions = sorted(stats.items(), key=lambda stat: -stat[1][2])
+        return [('{}:{}'.format(os.path.basename(filename), name),
+                 tottime / total if total else 0)
+                for (filename, _, name), (_, _, tottime, _, _)
+                in functions[:limit]]
+
+
+PROFILERS = {
+    'cprofile': (CProfiler, '.prof'),
+    'sample': (StackSampler, '.folded'),
+}
+
+
+class ReplayMember(object):
+    """
+    Stands in for an OpenHumansMember during a replay, profiling each phase.
+
+    The phase is the data_type of the latest status update.
+    """
+    oh_id = 'replay'
+
+    def __init__(self, profiler='cprofile'):
+        self.profiler_class, self.extension = PROFILERS[profiler]
+        self.phases = OrderedDict()
+        self.phase = None
+        self.phase_started = None
+        self.set_phase('probe')
+
+    def set_phase(self, phase):
+        if self.phase is not None:
+            self.phases[self.phase]['profiler'].disable()
+            self.phases[self.phase]['seconds'] += (
+                time.time() - self.phase_started)
+        self.phase = phase
+        if phase is not None:
+            self.phases.setdefault(phase, {
+                'profiler': self.profiler_class(), 'seconds': 0})
+            self.phase_started = time.time()
+            self.phases[phase]['profiler'].enable()
+
+    def set_xfer_status(self, status, **progress):
+        logger.debug(status)
+        phase = progress.get('data_type')
+        if phase and phase != self.phase:
+            self.set_phase(phase)
+
+
+def replay_transfer(archive_path, profiler='cprofile', out_dir=None):
+    """
+    Replay a recorded transfer, profiling each phase.
+
+    Profiles are written to out_dir, one file per phase, if given. Return
+    (member, replayer): member.phases maps each phase to its profiler and
+    wall time in seconds.
+    """
+    replayer = Replayer(archive_path)
+    header = replayer.header
+    member = ReplayMember(profiler)
+    # The recorded probe stands in for probing the (absent) site.
+    replay_probe_key = probe_cache_key(REPLAY_HOST)
+    cache.set(replay_probe_key, header['probe'], None)
+    tempdir = tempfile.mkdtemp()
+    set_transport(replayer)
+    try:
+        add_data_to_open_humans(
+            member, header['before_date'], header['after_date'],
+            'https://' + REPLAY_HOST, tempdir,
+            daily_summary=header['daily_summary'], upload=False)
+    finally:
+        member.set_phase(None)
+        set_transport(None)
+        cache.delete(replay_probe_key)
+        shutil.rmtree(tempdir)
+    if out_dir:
+        for phase, result in member.phases.items():
+            result['profiler'].dump(
+                os.path.join(out_dir, phase + member.extension))
+    return member, replayer
@@ -0,0 +1,118 @@
+"""
+Compact in-memory representation of Nightscout items.
+
+Devicestatus items are large nested documents (OpenAPS/Loop state) that we
+pass through untouched, apart from substituting the 'device' value. Holding
+whole windows of them as nested dicts made devicestatus the worker's memory
+peak. Items parsed with parse_compact_records instead keep:
+
+  * the common top-level fields as attributes of a __slots__ object, and
+  * all other fields as one compact, ASCII-only JSON string (bytes on
+    Python 2), which is written out as-is.
+
+CompactRecord supports item[key] access to its top-level fields, so code
+written for dicts (e.g. sub_sensitive) works on it unchanged.
+"""
+import json
+
+_decoder = json.JSONDecoder()
+_compact_dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+# Top-level fields whose values repeat across most items in a response.
+SHARED_FIELDS = ('device',)
+
+
+class CompactRecord(object):
+    """
+    A Nightscout item: top-level fields plus the rest as a JSON string.
+    """
+    __slots__ = ('_id', 'created_at', 'device', 'mills', 'utcOffset', 'extra')
+
+    FIELDS = __slots__[:-1]
+
+    def __init__(self, item, shared_values=None):
+        """
+        Build from a parsed item dict, which is emptied in the process.
+
+        Equal string values of SHARED_FIELDS are stored once in
+        shared_values.
+        """
+        if shared_values is None:
+            shared_values = {}
+        for field in self.FIELDS:
+            value = item.pop(field, self)
+            if value is not self:
+                # Other types may be unhashable, e.g. a dict from a
+                # non-standard uploader.
+                if field in SHARED_FIELDS and isinstance(value, basestring):
+                    value = shared_values.setdefault(value, value)
+                setattr(self, field, value)
+        # Remaining fields, encoded as the inside of a JSON object.
+        self.extra = _compact_dumps(item)[1:-1] if item else ''
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def to_json(self):
+        """
+        Return the item as a JSON object string.
+        """
+        parts = []
+        for field in self.FIELDS:
+            value = getattr(self, field, self)
+            if value is not self:
+                parts.append('"{}":{}'.format(field, _compact_dumps(value)))
+        if self.extra:
+            parts.append(self.extra)
+        return '{' + ','.join(parts) + '}'
+
+
+def iter_json_array(content):
+    """
+    Yield the items of a JSON array one at a time.
+
+    Only one item is decoded at a time, so the whole array never exists as
+    Python objects.
+    """
+    if not isinstance(content, str):
+        # Python 3 bytes; Python 2 decodes str items directly.
+        content = content.decode('utf-8')
+    pos = content.index('[') + 1
+    length = len(content)
+    while pos < length:
+        char = content[pos]
+        if char in ' \t\r\n,':
+            pos += 1
+        elif char == ']':
+            return
+        else:
+            item, pos = _decoder.raw_decode(content, pos)
+            yield item
+
+
+def parse_compact_records(content):
+    """
+    Parse a JSON array response into a list of CompactRecord objects.
+    """
+    shared_values = {}
+    return [CompactRecord(item, shared_values)
+            for item in iter_json_array(content)]
+
+
+def dumps(item):
+    """
+    Return a dict or CompactRecord as a JSON string.
+    """
+    if isinstance(item, CompactRecord):
+        return item.to_json()
+    return json.dumps(item)
@@ -0,0 +1,143 @@
+"""
+Optional local cache of Nightscout query results.
+
+Retried or overlapping transfers often repeat the same query windows. Set
+NS_RESPONSE_CACHE_DIR on a worker to keep results on its disk:
+
+  * Entries are named by an HMAC of the request URL and query parameters,
+    and encrypted (Fernet) with a key derived from the request URL and
+    SECRET_KEY. The URL is never stored, and entries can't be read without
+    it.
+  * Entries expire NS_RESPONSE_CACHE_TTL seconds after they're written.
+  * When the cache is larger than NS_RESPONSE_CACHE_MAX_BYTES, the least
+    recently used entries are removed.
+
+Requires the cryptography package; without it the cache stays disabled.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import tempfile
+import zlib
+
+from django.conf import settings
+
+CACHE_DIR = os.getenv('NS_RESPONSE_CACHE_DIR', '')
+CACHE_TTL = int(os.getenv('NS_RESPONSE_CACHE_TTL', '900'))
+CACHE_MAX_BYTES = int(os.getenv('NS_RESPONSE_CACHE_MAX_BYTES', '268435456'))
+
+# Set up logging.
+logger = logging.getLogger(__name__)
+
+
+def _hmac(purpose, url, params=None):
+    message = json.dumps([purpose, url, sorted((params or {}).items())])
+    return hmac.new(settings.SECRET_KEY.encode('utf-8'),
+                    message.encode('utf-8'), hashlib.sha256)
+
+
+def _fernet(url):
+    """
+    Return a Fernet cipher keyed to this request URL, or None if unavailable.
+    """
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError:
+        logger.warning('cryptography is not installed: response cache off.')
+        return None
+    key = base64.urlsafe_b64encode(_hmac('key', url).digest())
+    return Fernet(key)
+
+
+def _entry_path(url, params):
+    return os.path.join(CACHE_DIR, _hmac('entry', url, params).hexdigest())
+
+
+def get(url, params):
+    """
+    Return the cached response body for a request, or None.
+    """
+    if not CACHE_DIR:
+        return None
+    path = _entry_path(url, params)
+    try:
+        with open(path, 'rb') as f:
+            token = f.read()
+    except IOError:
+        return None
+    fernet = _fernet(url)
+    if not fernet:
+        return None
+    from cryptography.fernet import InvalidToken
+    try:
+        data = fernet.decrypt(token, ttl=CACHE_TTL)
+    except InvalidToken:
+        # Expired (or written with another SECRET_KEY).
+        _remove(path)
+        return None
+    # Mark as recently used, for eviction.
+    try:
+        os.utime(path, None)
+    except OSError:
+        # Evicted by another worker since it was read.
+        pass
+    return zlib.decompress(data)
+
+
+def put(url, params, content):
+    """
+    Cache a response body for a request, then evict entries if over size.
+    """
+    if not CACHE_DIR:
+        return
+    fernet = _fernet(url)
+    if not fernet:
+        return
+    token = fernet.encrypt(zlib.compress(content))
+    if not os.path.isdir(CACHE_DIR):
+        try:
+            os.makedirs(CACHE_DIR)
+        except OSError:
+            # Created by another worker meanwhile.
+            if not os.path.isdir(CACHE_DIR):
+                raise
+    # Write to a temporary file first so readers never see partial entries.
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(token)
+    os.rename(tmp_path, _entry_path(url, params))
+    evict()
+
+
+def evict(max_bytes=None):
+    """
+    Remove least recently used entries until the cache fits in max_bytes.
+    """
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith('.tmp'):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        _remove(path)
+        total -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -85,6 +85,40 @@ DATABASES = {
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Cache shared by the web and worker processes, so a worker can invalidate
+# what the web process cached. The table is created by the Procfile's release
+# step, or locally with:
+#   python manage.py createcachetable
+# Once MAX_ENTRIES is reached, expired entries and then a third of the rest
+# are culled.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'oh_data_source_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+            'CULL_FREQUENCY': 3,
+        },
+    },
+    # Transfer tasks' idempotency records (see tasks.py), kept apart so
+    # they aren't culled to make room for other entries. Culling removes
+    # expired records first, so with this limit live ones are kept.
+    'xfer': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'oh_data_source_xfer_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000000,
+        },
+    },
+}
+
+# Close the database connection after each transfer status update (set by
+# worker_settings.py for the gevent pool).
+XFER_STATUS_CLOSE_DB = False
+
+# Seconds to cache Open Humans member data shown on the home page.
+OH_MEMBER_DATA_CACHE_TTL = int(os.getenv('OH_MEMBER_DATA_CACHE_TTL', '60'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
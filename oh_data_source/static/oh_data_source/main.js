@@ -49,3 +49,40 @@ $(document).ready(function(){
 		$(this).val('');
 	});
 }); // end of $(document).ready()
+
+// Poll transfer progress while a transfer is running. jQuery's ifModified
+// option sends the last ETag, so unchanged progress costs a 304 response.
+$(document).ready(function(){
+	var $status = $('#xfer-status');
+	if (!$status.length) {
+		return;
+	}
+
+	function pollStatus() {
+		$.ajax({
+			url: $status.data('url'),
+			dataType: 'json',
+			ifModified: true
+		}).done(function(progress, textStatus) {
+			if (textStatus === 'notmodified') {
+				return;
+			}
+			$('#xfer-status-text').text(progress.status);
+			if (progress.data_type) {
+				$('#xfer-status-bar')
+					.css('width', progress.percent + '%')
+					.text(progress.data_type + ': ' + progress.records + ' records');
+			}
+			if (progress.status === 'Complete' || progress.status === 'Failed' ||
+					progress.status.indexOf('Aborted') === 0 ||
+					progress.status.indexOf('Partial') === 0) {
+				// Reload to show the new files in Open Humans.
+				window.location.reload();
+			}
+		}).always(function() {
+			setTimeout(pollStatus, 5000);
+		});
+	}
+
+	pollStatus();
+});
@@ -0,0 +1,126 @@
+"""
+Daily summaries computed while entries and treatments are crawled.
+
+DailySummary receives each window's items as they stream past and keeps only
+running per-day totals, so memory grows with the number of days, not items.
+The result is a small JSON file with one object per (UTC) day:
+
+  * readings, mean_glucose and sd_glucose (mg/dL) from sgv entries,
+  * time_below_range, time_in_range and time_above_range, as percentages
+    of readings (range is GLUCOSE_LOW to GLUCOSE_HIGH inclusive),
+  * insulin (U) and carbs (g) totals from treatments.
+"""
+import json
+import math
+
+import arrow
+
+GLUCOSE_LOW = 70
+GLUCOSE_HIGH = 180
+
+# Indices into each day's running totals.
+(READINGS, GLUCOSE_SUM, GLUCOSE_SQ_SUM, BELOW, IN_RANGE, ABOVE, INSULIN,
+ CARBS) = range(8)
+
+
+def _number(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(value) or math.isinf(value):
+        return None
+    return value
+
+
+class DailySummary(object):
+    """
+    Running per-day glucose, insulin and carb aggregates.
+    """
+    def __init__(self, low=GLUCOSE_LOW, high=GLUCOSE_HIGH):
+        self.low = low
+        self.high = high
+        self.days = {}
+
+    def _day(self, timestamp):
+        # Times with an offset are counted on their UTC day.
+        day = arrow.get(timestamp).to('utc').format('YYYY-MM-DD')
+        totals = self.days.get(day)
+        if totals is None:
+            totals = self.days[day] = [0] * 8
+        return totals
+
+    def add_entries(self, items):
+        """
+        Add a window of entries. Only sgv readings are counted.
+        """
+        # Bucket the batch first, then update each day's totals once.
+        by_day = {}
+        for item in items:
+            if item.get('type') != 'sgv':
+                continue
+            sgv = _number(item.get('sgv'))
+            date = _number(item.get('date'))
+            if sgv is None or date is None:
+                continue
+            by_day.setdefault(date // 86400000, []).append(sgv)
+        for day_number, values in by_day.items():
+            totals = self._day(day_number * 86400)
+            totals[READINGS] += len(values)
+            totals[GLUCOSE_SUM] += sum(values)
+            totals[GLUCOSE_SQ_SUM] += sum(v * v for v in values)
+            below = sum(1 for v in values if v < self.low)
+            above = sum(1 for v in values if v > self.high)
+            totals[BELOW] += below
+            totals[ABOVE] += above
+            totals[IN_RANGE] += len(values) - below - above
+
+    def add_treatments(self, items):
+        """
+        Add a window of treatments, totalling insulin and carbs per day.
+        """
+        for item in items:
+            insulin = _number(item.get('insulin'))
+            carbs = _number(item.get('carbs'))
+            if not insulin and not carbs:
+                continue
+            try:
+                totals = self._day(item['created_at'])
+            except (KeyError, TypeError, ValueError,
+                    arrow.parser.ParserError):
+                continue
+            totals[INSULIN] += insulin or 0
+            totals[CARBS] += carbs or 0
+
+    def rows(self):
+        """
+        Return the summary as a list of per-day dicts, oldest first.
+        """
+        rows = []
+        for day in sorted(self.days):
+            totals = self.days[day]
+            row = {
+                'date': day,
+                'readings': totals[READINGS],
+                'insulin': round(totals[INSULIN], 2),
+                'carbs': round(totals[CARBS], 1),
+            }
+            n = totals[READINGS]
+            if n:
+                mean = totals[GLUCOSE_SUM] / n
+                variance = max(totals[GLUCOSE_SQ_SUM] / n - mean * mean, 0)
+                row.update({
+                    'mean_glucose': round(mean, 1),
+                    'sd_glucose': round(math.sqrt(variance), 1),
+                    'time_below_range': round(100.0 * totals[BELOW] / n, 1),
+                    'time_in_range': round(100.0 * totals[IN_RANGE] / n, 1),
+                    'time_above_range': round(100.0 * totals[ABOVE] / n, 1),
+                })
+            rows.append(row)
+        return rows
+
+    def write(self, file_obj):
+        """
+        Write the summary to file_obj as a JSON array.
+        """
+        json.dump(self.rows(), file_obj, sort_keys=True)
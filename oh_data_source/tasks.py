@@ -17,11 +17,17 @@ from urllib2 import HTTPError
 
 import arrow
 from celery import shared_task
+from django.core.cache import caches
 from django.utils import lorem_ipsum
 import requests
 
+from .budget import TransferBudget
+from .filters import entries_filter
 from .models import OpenHumansMember
-from .nightscout_data import normalize_url, ns_data_file
+from .nightscout_data import (PROFILE_INDEX_TAG, entries_index_data_file,
+                              ns_data_file, probe_ns_site, profile_data_files,
+                              summary_data_file)
+from .summary import DailySummary
 
 OH_API_BASE = 'https://www.openhumans.org/api/direct-sharing'
 OH_EXCHANGE_TOKEN = OH_API_BASE + '/project/exchange-member/'
@@ -29,80 +35,171 @@ OH_DELETE_FILES = OH_API_BASE + '/project/files/delete/'
 OH_DIRECT_UPLOAD = OH_API_BASE + '/project/files/upload/direct/'
 OH_DIRECT_UPLOAD_COMPLETE = OH_API_BASE + '/project/files/upload/complete/'
 
+# Seconds an access token must stay valid for before uploads begin.
+UPLOAD_TOKEN_MIN_VALID = 3600
+
+# Seconds to remember a transfer task's progress, so that a redelivered task
+# (see celery_config.py) doesn't repeat its uploads.
+XFER_IDEMPOTENCY_TTL = 7 * 24 * 3600
+
+# Cache alias for those records (see settings.py).
+XFER_CACHE = 'xfer'
+
 # Set up logging.
 logger = logging.getLogger(__name__)
 
 
-@shared_task
-def xfer_to_open_humans(oh_id, ns_before, ns_after, ns_url, num_submit=0):
+def xfer_cache_key(task_id, name):
+    """
+    Return a cache key for one transfer task's idempotency records.
+    """
+    return 'xfer-{}-{}'.format(name, task_id)
+
+
+@shared_task(bind=True)
+def xfer_to_open_humans(self, oh_id, ns_before, ns_after, ns_url,
+                        num_submit=0, daily_summary=False, entry_types=None,
+                        entry_core_fields=False):
     """
     Transfer data to Open Humans.
 
     num_submit is an optional parameter in case you want to resubmit failed
-    tasks (see comments in code).
+    tasks (see comments in code). If daily_summary is True, a file of daily
+    aggregates is uploaded along with the raw data. entry_types and
+    entry_core_fields choose which entries to keep (see filters.py).
+
+    The transfer is limited by a TransferBudget; if it runs out, whatever was
+    retrieved is uploaded, labelled as partial.
+
+    Tasks are acknowledged late, so one may be delivered again if its worker
+    stopped. A task that already finished does nothing, and one that stopped
+    mid-way skips the files it already uploaded.
     """
+    task_id = self.request.id
+    if task_id and caches[XFER_CACHE].get(xfer_cache_key(task_id, 'done')):
+        logger.info('Transfer task {} already done.'.format(task_id))
+        return
     logger.debug('Trying to transfer data for {} to Open Humans'.format(oh_id))
     oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
-    oh_member.last_xfer_status = 'Initiated'
-    oh_member.save()
+    oh_member.set_xfer_status('Initiated')
 
     # Make a tempdir for all temporary files.
     # Delete this even if an exception occurs.
     tempdir = tempfile.mkdtemp()
+    budget = TransferBudget()
     try:
-        add_data_to_open_humans(
-            oh_member, ns_before, ns_after, ns_url, tempdir)
-        oh_member.last_xfer_status = 'Complete'
-        oh_member.save()
+        if add_data_to_open_humans(
+                oh_member, ns_before, ns_after, ns_url, tempdir,
+                daily_summary=daily_summary, budget=budget, task_id=task_id,
+                entry_types=entry_types, entry_core_fields=entry_core_fields):
+            if budget.partial:
+                oh_member.set_xfer_status(
+                    'Partial: ' + budget.partial_reason())
+            else:
+                oh_member.set_xfer_status('Complete')
+        if task_id:
+            caches[XFER_CACHE].set(xfer_cache_key(task_id, 'done'), True,
+                                   XFER_IDEMPOTENCY_TTL)
     except:
-        oh_member.last_xfer_status = 'Failed'
-        oh_member.save()
+        oh_member.set_xfer_status('Failed')
     finally:
         shutil.rmtree(tempdir)
+        # The member's Open Humans files may have changed.
+        oh_member.clear_cached_member_data()
 
 
-def add_data_to_open_humans(oh_member, ns_before, ns_after, ns_url, tempdir):
+def add_data_to_open_humans(oh_member, ns_before, ns_after, ns_url, tempdir,
+                            daily_summary=False, upload=True, budget=None,
+                            task_id=None, entry_types=None,
+                            entry_core_fields=False):
     """
     Add Nightscout data to Open Humans.
+
+    If daily_summary is True, also add daily aggregates computed from the
+    entries and treatments as they're retrieved. If upload is False, the
+    files are only written to tempdir (see recording.py). budget is passed
+    on to ns_data_file. If given, task_id is used to skip files this task
+    already uploaded (see upload_files_once). entry_types and
+    entry_core_fields select the entries kept (see filters.entries_filter).
+
+    Return True if data was added, False if the transfer was aborted.
     """
     # Ensure Nightscout URL is formatted to contains scheme and is responsive.
-    ns_url = normalize_url(ns_url)
-    if not ns_url:
-        oh_member.last_xfer_status = 'Aborted: URL did not return 200 status.'
-        oh_member.save()
+    # The probe also tells us where each data type's records begin.
+    probe = probe_ns_site(ns_url)
+    if not probe:
+        oh_member.set_xfer_status('Aborted: URL did not return 200 status.')
+        return False
+    ns_url = probe['url']
+    earliest = probe['earliest']
+    time_fields = probe.get('time_fields', {})
 
     # Use current datetime for "before" date if unspecified.
     if not ns_before:
         ns_before = arrow.get().format('YYYY-MM-DD')
 
+    summary = DailySummary() if daily_summary else None
+
     # Entries data.
     entries_filepath, entries_metadata = ns_data_file(
         oh_member=oh_member, tempdir=tempdir, ns_url=ns_url,
-        data_type='entries', before_date=ns_before, after_date=ns_after)
+        data_type='entries', before_date=ns_before, after_date=ns_after,
+        earliest=earliest['entries'], budget=budget,
+        time_field=time_fields.get('entries'),
+        item_filter=entries_filter(entry_types, entry_core_fields),
+        on_items=summary.add_entries if summary else None)
+    entries_index_filepath, entries_index_metadata = entries_index_data_file(
+        entries_filepath, before_date=ns_before, after_date=ns_after)
 
     # Treatments data.
     treatments_filepath, treatments_metadata = ns_data_file(
         oh_member=oh_member, tempdir=tempdir, ns_url=ns_url,
-        data_type='treatments', before_date=ns_before, after_date=ns_after)
+        data_type='treatments', before_date=ns_before, after_date=ns_after,
+        earliest=earliest['treatments'], budget=budget,
+        time_field=time_fields.get('treatments'),
+        on_items=summary.add_treatments if summary else None)
 
     # Devicestatus data.
     devicestatus_filepath, devicestatus_metadata = ns_data_file(
         oh_member=oh_member, tempdir=tempdir, ns_url=ns_url,
-        data_type='devicestatus', before_date=ns_before, after_date=ns_after)
+        data_type='devicestatus', before_date=ns_before, after_date=ns_after,
+        earliest=earliest['devicestatus'], budget=budget,
+        time_field=time_fields.get('devicestatus'))
 
-    # Profile data.
-    profile_filepath, profile_metadata = ns_data_file(
+    # Profile data: only versions that haven't been uploaded before.
+    profile_files = profile_data_files(
         oh_member=oh_member, tempdir=tempdir, ns_url=ns_url,
-        data_type='profile', before_date=ns_before, after_date=ns_after)
+        before_date=ns_before, after_date=ns_after,
+        previous_index=previous_profile_index(oh_member) if upload else None)
+
+    if summary:
+        summary_filepath, summary_metadata = summary_data_file(
+            summary, tempdir, before_date=ns_before, after_date=ns_after)
+
+    if not upload:
+        return True
+
+    # Refresh now if the token could expire during the uploads, rather than
+    # mid-way through them.
+    oh_member.get_access_token(min_valid=UPLOAD_TOKEN_MIN_VALID)
 
     # Remove all files previously added to Open Humans.
     delete_all_oh_files(oh_member)
 
-    # Upload files to Open Humans.
-    upload_file_to_oh(oh_member, entries_filepath, entries_metadata)
-    upload_file_to_oh(oh_member, treatments_filepath, treatments_metadata)
-    upload_file_to_oh(oh_member, profile_filepath, profile_metadata)
-    upload_file_to_oh(oh_member, devicestatus_filepath, devicestatus_metadata)
+    # Upload files to Open Humans, each data file with its index.
+    upload_files_once(oh_member, [
+        (entries_filepath, entries_metadata),
+        (entries_index_filepath, entries_index_metadata)], 'entries', task_id)
+    upload_files_once(oh_member, [(treatments_filepath, treatments_metadata)],
+                      'treatments', task_id)
+    upload_files_once(oh_member, profile_files, 'profile', task_id)
+    upload_files_once(oh_member,
+                      [(devicestatus_filepath, devicestatus_metadata)],
+                      'devicestatus', task_id)
+    if summary:
+        upload_files_once(oh_member, [(summary_filepath, summary_metadata)],
+                          'summary', task_id)
+    return True
 
 
 def make_example_datafile(tempdir):
@@ -121,6 +218,27 @@ def make_example_datafile(tempdir):
     return filepath, metadata
 
 
+def previous_profile_index(oh_member):
+    """
+    Return the profile index most recently uploaded for this member, or None.
+    """
+    req = requests.get(OH_EXCHANGE_TOKEN,
+                       params={'access_token': oh_member.get_access_token()})
+    if req.status_code != 200:
+        logger.debug('Member data status code: {}'.format(req.status_code))
+        return None
+    indexes = [data_file for data_file in req.json().get('data', [])
+               if PROFILE_INDEX_TAG in data_file['metadata'].get('tags', [])]
+    if not indexes:
+        return None
+    latest = max(indexes, key=lambda data_file: data_file['created'])
+    req = requests.get(latest['download_url'])
+    if req.status_code != 200:
+        logger.debug('Profile index status code: {}'.format(req.status_code))
+        return None
+    return req.json()
+
+
 def delete_all_oh_files(oh_member):
     """
     Delete all current project files in Open Humans for this project member.
@@ -134,6 +252,34 @@ def delete_all_oh_files(oh_member):
     # logger.debug('Files deleted. Status code: {}'.format(req.status_code))
 
 
+def upload_files_once(oh_member, data_files, role, task_id=None):
+    """
+    Upload files to Open Humans, unless this task already uploaded them.
+
+    data_files is a list of (path, metadata), e.g. a data file and its
+    index, which are uploaded and remembered together: an index from one
+    run never describes a data file from another. role names their part in
+    the transfer, e.g. 'entries'. Uploads are remembered by task_id and
+    role, not by content: a redelivered task crawls again, and its files
+    differ from the first run's (gzip headers hold the time, and the crawl
+    may reach further). Without a task_id, the files are always uploaded.
+    """
+    if not task_id:
+        for filepath, metadata in data_files:
+            upload_file_to_oh(oh_member, filepath, metadata)
+        return
+    cache_key = xfer_cache_key(task_id, 'uploaded')
+    uploaded = caches[XFER_CACHE].get(cache_key, [])
+    if role in uploaded:
+        logger.debug('Already uploaded {} for member {}.'.format(
+            role, oh_member.oh_id))
+        return
+    for filepath, metadata in data_files:
+        upload_file_to_oh(oh_member, filepath, metadata)
+    caches[XFER_CACHE].set(cache_key, uploaded + [role],
+                           XFER_IDEMPOTENCY_TTL)
+
+
 def upload_file_to_oh(oh_member, filepath, metadata):
     """
     This demonstrates using the Open Humans "large file" upload process.
@@ -145,9 +291,11 @@ def upload_file_to_oh(oh_member, filepath, metadata):
     This process is "direct to S3" using three steps: 1. get S3 target URL from
     Open Humans, 2. Perform the upload, 3. Notify Open Humans when complete.
     """
+    access_token = oh_member.get_access_token()
+
     # Get the S3 target from Open Humans.
     upload_url = '{}?access_token={}'.format(
-        OH_DIRECT_UPLOAD, oh_member.get_access_token())
+        OH_DIRECT_UPLOAD, access_token)
     req1 = requests.post(
         upload_url,
         data={'project_member_id': oh_member.oh_id,
@@ -166,7 +314,7 @@ def upload_file_to_oh(oh_member, filepath, metadata):
 
     # Report completed upload to Open Humans.
     complete_url = ('{}?access_token={}'.format(
-        OH_DIRECT_UPLOAD_COMPLETE, oh_member.get_access_token()))
+        OH_DIRECT_UPLOAD_COMPLETE, access_token))
     req3 = requests.post(
         complete_url,
         data={'project_member_id': oh_member.oh_id,
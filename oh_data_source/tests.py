@@ -0,0 +1,709 @@
+"""
+Tests for crawling Nightscout collections and transferring the results.
+
+Crawls run against FakeNightscout, an in-memory site installed with
+set_transport(), so no network access is needed.
+"""
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+import arrow
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase
+import requests
+
+from . import response_cache, tasks
+from .budget import TransferBudget
+from .celery_config import CELERY_BROKER_URL
+from .crawl_engine import ConcurrentEngine, SyncEngine
+from .filters import EntriesFilter, entries_filter
+from .management.commands import bulk_transfer
+from .models import OpenHumansMember
+from .nightscout_data import (PROFILE_INDEX_TAG, crawl_collection,
+                              probe_ns_site, profile_data_files, set_transport)
+from .summary import DailySummary
+from .writers import IndexedEntriesWriter, read_block
+
+FIND_PARAM = re.compile(r'find\[(\w+)\](?:\[\$(\w+)\])?')
+
+COMPARISONS = {
+    None: lambda value, target: value == target,
+    'lt': lambda value, target: value < target,
+    'lte': lambda value, target: value <= target,
+    'gt': lambda value, target: value > target,
+    'gte': lambda value, target: value >= target,
+    'ne': lambda value, target: value != target,
+    'in': lambda value, target: value in target,
+    'nin': lambda value, target: value not in target,
+}
+
+# Comparisons that, as in MongoDB, also match items without the field.
+MATCH_MISSING = ('ne', 'nin')
+
+
+class FakeNightscout(object):
+    """
+    A transport for set_transport() that answers v1 API queries from memory.
+
+    Supports the find[] comparisons used by the crawler and EntriesFilter,
+    and returns the newest items first, like Nightscout. Filters on fields
+    in ignored_fields are ignored, like an older server might.
+    """
+    def __init__(self, **collections):
+        self.collections = collections
+        self.requests = []
+        self.served = []
+        self.ignored_fields = ()
+
+    def __call__(self, url, params):
+        self.requests.append(params)
+        collection = url.rsplit('/', 1)[-1][:-len('.json')]
+        time_field = 'date' if collection == 'entries' else 'created_at'
+        items = [item for item in self.collections.get(collection, [])
+                 if self.matches(item, params)]
+        items.sort(key=lambda item: item.get(time_field), reverse=True)
+        items = items[:int(params.get('count', 10))]
+        if int(params.get('count', 10)) > 1:
+            # Items returned by window queries, not single-item lookups.
+            self.served.extend(item.get('_id') for item in items)
+        return json.dumps(items)
+
+    def matches(self, item, params):
+        for key, target in params.items():
+            match = FIND_PARAM.match(key)
+            if not match:
+                continue
+            field, op = match.groups()
+            if field in self.ignored_fields:
+                continue
+            if op == 'exists':
+                if (field in item) != (target != 'false'):
+                    return False
+                continue
+            if field not in item:
+                if op in MATCH_MISSING:
+                    continue
+                return False
+            value = item[field]
+            # Nightscout compares numbers with numbers, strings as strings.
+            if isinstance(value, (int, long, float)):
+                target = float(target)
+            if not COMPARISONS[op](value, target):
+                return False
+        return True
+
+
+class FakeMember(object):
+    oh_id = 'test'
+
+    def set_xfer_status(self, status, **progress):
+        self.status = status
+
+    def get_access_token(self, **kwargs):
+        return 'token'
+
+
+class ListWriter(object):
+    def __init__(self):
+        self.items = []
+
+    def write_items(self, items):
+        self.items.extend(items)
+
+    def finish(self):
+        pass
+
+
+def make_entries(start, count, minutes=5):
+    return [{'_id': 'e{}'.format(i), 'type': 'sgv', 'sgv': 100,
+             'date': start.replace(minutes=+minutes * i).timestamp * 1000}
+            for i in range(count)]
+
+
+class CrawlTests(SimpleTestCase):
+    def tearDown(self):
+        set_transport(None)
+
+    def crawl(self, site, collection, before_date, after_date, **kwargs):
+        set_transport(site)
+        writer = ListWriter()
+        crawl_collection(FakeMember(), 'https://ns.invalid', writer,
+                         collection, before_date, after_date, **kwargs)
+        return writer.items
+
+    def test_crawl_retrieves_each_entry_once(self):
+        entries = make_entries(arrow.get('2019-03-01'), 30 * 288)
+        items = self.crawl(FakeNightscout(entries=entries), 'entries',
+                           '2019-04-30', '2019-01-01')
+        self.assertEqual(sorted(item['_id'] for item in items),
+                         sorted(entry['_id'] for entry in entries))
+
+    def test_engines_write_the_same_items(self):
+        site = FakeNightscout(entries=make_entries(
+            arrow.get('2018-06-01'), 200 * 24, minutes=60))
+        sync_items = self.crawl(site, 'entries', '2019-01-01', '',
+                                engine=SyncEngine())
+        concurrent_items = self.crawl(site, 'entries', '2019-01-01', '',
+                                      engine=ConcurrentEngine(3))
+        self.assertEqual(len(sync_items), 200 * 24)
+        self.assertEqual(sync_items, concurrent_items)
+
+    def test_newest_entry_with_milliseconds_is_kept(self):
+        start = arrow.get('2019-03-01T00:00:00.437000+00:00')
+        entries = [dict(entry, date=entry['date'] + 437)
+                   for entry in make_entries(start, 100)]
+        items = self.crawl(FakeNightscout(entries=entries), 'entries',
+                           '2019-04-30', '2019-01-01')
+        self.assertEqual(len(items), 100)
+        self.assertIn(entries[-1]['_id'], [item['_id'] for item in items])
+
+    def test_iso_times_with_offsets_are_each_fetched_once(self):
+        offsets = ['+00:00', '+05:00', '-08:00', '+14:00', '-12:00']
+        start = arrow.get('2019-03-01')
+        treatments = [
+            {'_id': 't{}'.format(i), 'insulin': 1,
+             'created_at': start.replace(hours=+4 * i).to(
+                 offsets[i % len(offsets)]).isoformat()}
+            for i in range(60 * 6)]
+        site = FakeNightscout(treatments=treatments)
+        items = self.crawl(site, 'treatments', '2019-04-10', '2019-03-10')
+        expected = [
+            treatment['_id'] for treatment in treatments
+            if arrow.get('2019-03-10') < arrow.get(treatment['created_at'])
+            <= arrow.get('2019-04-10')]
+        self.assertEqual(sorted(item['_id'] for item in items),
+                         sorted(expected))
+        # Windows aren't widened into each other, so nothing is fetched
+        # twice.
+        self.assertEqual(len(site.served), len(set(site.served)))
+
+    def test_numeric_time_field_not_in_server_order(self):
+        def treatment(_id, created_at, date):
+            return {'_id': _id, 'insulin': 1, 'created_at': created_at,
+                    'date': arrow.get(date).timestamp * 1000}
+        # Nightscout sorts treatments by created_at strings, so a is
+        # returned first although b is newer.
+        treatments = [
+            treatment('a', '2019-04-01T20:00:00+14:00', '2019-04-01T06:00Z'),
+            treatment('b', '2019-04-01T10:00:00Z', '2019-04-01T10:00Z'),
+            treatment('c', '2019-03-20T00:00:00Z', '2019-03-20T00:00Z')]
+        items = self.crawl(FakeNightscout(treatments=treatments),
+                           'treatments', '2019-04-10', '2019-03-10',
+                           time_field='date')
+        self.assertEqual(sorted(item['_id'] for item in items),
+                         ['a', 'b', 'c'])
+
+    def test_devicestatus_with_unhashable_device(self):
+        devicestatus = [
+            {'_id': 'd1', 'created_at': '2019-03-01T00:00:00+00:00',
+             'device': {'name': 'pump'}},
+            {'_id': 'd2', 'created_at': '2019-03-01T01:00:00+00:00',
+             'device': 'openaps://phone'}]
+        items = self.crawl(FakeNightscout(devicestatus=devicestatus),
+                           'devicestatus', '2019-03-02', '2019-02-28')
+        self.assertEqual(sorted(item['_id'] for item in items),
+                         ['d1', 'd2'])
+
+    def test_memory_used_before_the_transfer_is_not_charged(self):
+        # The test process already uses more than 10 MB.
+        budget = TransferBudget(max_memory_mb=10)
+        entries = make_entries(arrow.get('2019-03-01'), 100)
+        items = self.crawl(FakeNightscout(entries=entries), 'entries',
+                           '2019-04-30', '2019-01-01', budget=budget)
+        self.assertEqual(len(items), 100)
+        self.assertEqual(budget.partial, {})
+
+    def test_heaviest_transfer_is_stopped_for_memory(self):
+        light = TransferBudget(max_mb=0, max_memory_mb=10)
+        heavy = TransferBudget(max_mb=0, max_memory_mb=10)
+        heavy.add_bytes(1 << 40)
+        heavy.start_memory = light.start_memory = 0
+        self.assertIsNone(light.exceeded())
+        self.assertEqual(heavy.exceeded(), 'memory limit reached')
+
+
+def make_mixed_entries():
+    """
+    Return 12 entries: 6 sgv, 2 each of mbg and cal, 1 rawbg and 1 untyped.
+    """
+    entries = make_entries(arrow.get('2019-03-01'), 12)
+    types = ['sgv', 'mbg', 'sgv', 'cal', 'sgv', 'rawbg',
+             'sgv', 'mbg', 'sgv', 'cal', 'sgv', None]
+    for entry, entry_type in zip(entries, types):
+        entry['noise'] = 1
+        entry['rssi'] = 80
+        if entry_type:
+            entry['type'] = entry_type
+        else:
+            del entry['type']
+    return entries
+
+
+class EntriesFilterTests(SimpleTestCase):
+    def tearDown(self):
+        set_transport(None)
+
+    def crawl(self, site, item_filter):
+        set_transport(site)
+        writer = ListWriter()
+        crawl_collection(FakeMember(), 'https://ns.invalid', writer,
+                         'entries', '2019-04-01', '2019-02-01',
+                         item_filter=item_filter)
+        return writer.items
+
+    def test_params(self):
+        def params(*types):
+            return EntriesFilter(types).params()
+        self.assertEqual(params('sgv'), {'find[type]': 'sgv'})
+        self.assertEqual(params('sgv', 'mbg'),
+                         {'find[type][$in][]': ['mbg', 'sgv']})
+        self.assertEqual(params('sgv', 'mbg', 'other'),
+                         {'find[type][$ne]': 'cal'})
+        self.assertEqual(params('sgv', 'other'),
+                         {'find[type][$nin][]': ['cal', 'mbg']})
+        self.assertEqual(params('sgv', 'mbg', 'cal', 'other'), {})
+
+    def test_apply_counts_skipped_types(self):
+        item_filter = EntriesFilter(['sgv', 'cal'], core_fields_only=True)
+        kept = item_filter.apply(make_mixed_entries())
+        self.assertEqual(sorted(item['type'] for item in kept),
+                         ['cal'] * 2 + ['sgv'] * 6)
+        self.assertEqual(sorted(kept[0]), ['_id', 'date', 'noise', 'sgv',
+                                           'type'])
+        self.assertEqual(item_filter.skipped,
+                         {'mbg': 2, 'rawbg': 1, 'untyped': 1})
+
+    def test_describe(self):
+        item_filter = EntriesFilter(['sgv', 'other'], core_fields_only=True)
+        item_filter.apply(make_mixed_entries())
+        self.assertEqual(
+            item_filter.describe(),
+            'types: sgv, other; filtered in queries; skipped 2 cal, 2 mbg; '
+            'core fields only')
+        self.assertEqual(EntriesFilter(['sgv', 'mbg', 'cal', 'other'],
+                                       core_fields_only=True).describe(),
+                         'types: cal, mbg, sgv, other; core fields only')
+
+    def test_entries_filter_is_none_when_keeping_everything(self):
+        self.assertIsNone(entries_filter())
+        self.assertIsNone(entries_filter(['sgv', 'mbg', 'cal', 'other']))
+        self.assertIsNotNone(entries_filter(core_fields_only=True))
+        self.assertEqual(entries_filter(['sgv']).types, {'sgv'})
+
+    def test_types_are_filtered_in_queries(self):
+        site = FakeNightscout(entries=make_mixed_entries())
+        item_filter = entries_filter(['sgv', 'other'])
+        items = self.crawl(site, item_filter)
+        self.assertEqual(sorted(item.get('type') for item in items),
+                         [None, 'rawbg'] + ['sgv'] * 6)
+        # The server left out the rest, so nothing was skipped here.
+        self.assertEqual(item_filter.skipped, {})
+        self.assertTrue(all(params.get('find[type][$nin][]') ==
+                            ['cal', 'mbg'] for params in site.requests
+                            if int(params['count']) > 1))
+
+    def test_types_ignored_by_the_server_are_skipped(self):
+        site = FakeNightscout(entries=make_mixed_entries())
+        site.ignored_fields = ('type',)
+        item_filter = entries_filter(['sgv', 'mbg'])
+        items = self.crawl(site, item_filter)
+        self.assertEqual(sorted(item['type'] for item in items),
+                         ['mbg'] * 2 + ['sgv'] * 6)
+        self.assertEqual(item_filter.skipped,
+                         {'cal': 2, 'rawbg': 1, 'untyped': 1})
+
+
+def make_profile(i, basal):
+    return {'_id': 'p{}'.format(i), 'defaultProfile': 'Default',
+            'created_at': '2019-03-0{}T00:00:00Z'.format(i),
+            'startDate': '2019-03-0{}T00:00:00Z'.format(i),
+            'store': {'Default': {'basal': [{'time': '00:00',
+                                             'value': basal}]}}}
+
+
+class ProfileTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        set_transport(None)
+        shutil.rmtree(self.tmp_dir)
+
+    def profile_files(self, profiles, previous_index=None):
+        """
+        Return the versions written and the index, if they were written.
+        """
+        set_transport(FakeNightscout(profile=profiles))
+        files = profile_data_files(FakeMember(), self.tmp_dir,
+                                   'https://ns.invalid', '2019-04-01', '',
+                                   previous_index=previous_index)
+        versions, index = None, None
+        for filepath, metadata in files:
+            if PROFILE_INDEX_TAG in metadata['tags']:
+                with open(filepath) as f:
+                    index = json.load(f)
+            else:
+                with gzip.open(filepath) as f:
+                    versions = json.load(f)
+        return versions, index
+
+    def test_first_run_writes_each_version_once(self):
+        profiles = [make_profile(1, 0.5), make_profile(2, 0.5),
+                    make_profile(3, 0.8)]
+        versions, index = self.profile_files(profiles)
+        self.assertEqual([profile['_id'] for profile in versions],
+                         ['p1', 'p3'])
+        self.assertEqual([document['_id'] for document in index['documents']],
+                         ['p1', 'p2', 'p3'])
+        self.assertEqual(len(index['versions']), 2)
+
+    def test_unchanged_rerun_writes_nothing(self):
+        profiles = [make_profile(1, 0.5), make_profile(2, 0.8)]
+        _, index = self.profile_files(profiles)
+        self.assertEqual(self.profile_files(profiles, index), (None, None))
+
+    def test_changed_profile_writes_only_the_new_version(self):
+        profiles = [make_profile(1, 0.5), make_profile(2, 0.8)]
+        _, first_index = self.profile_files(profiles)
+        profiles.append(make_profile(3, 1.0))
+        versions, index = self.profile_files(profiles, first_index)
+        self.assertEqual([profile['_id'] for profile in versions], ['p3'])
+        self.assertEqual([document['_id'] for document in index['documents']],
+                         ['p1', 'p2', 'p3'])
+        # Earlier versions still point to the first run's file.
+        for digest, version in first_index['versions'].items():
+            self.assertEqual(index['versions'][digest], version)
+
+
+class PreviousProfileIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.requests_get = requests.get
+
+    def tearDown(self):
+        requests.get = self.requests_get
+
+    def test_latest_index_is_used(self):
+        member_data = {'data': [
+            {'created': '2019-03-01T00:00:00Z', 'download_url': 'old',
+             'metadata': {'tags': [PROFILE_INDEX_TAG]}},
+            {'created': '2019-04-01T00:00:00Z', 'download_url': 'new',
+             'metadata': {'tags': [PROFILE_INDEX_TAG]}},
+            {'created': '2019-05-01T00:00:00Z', 'download_url': 'profile',
+             'metadata': {'tags': ['profile']}}]}
+
+        def get(url, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps(
+                member_data if url == tasks.OH_EXCHANGE_TOKEN else {'url': url})
+            return response
+        requests.get = get
+        self.assertEqual(tasks.previous_profile_index(FakeMember()),
+                         {'url': 'new'})
+
+    def test_first_run_has_no_index(self):
+        def get(url, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps({'data': []})
+            return response
+        requests.get = get
+        self.assertIsNone(tasks.previous_profile_index(FakeMember()))
+
+
+class DailySummaryTests(SimpleTestCase):
+    def test_treatments_are_counted_on_their_utc_day(self):
+        summary = DailySummary()
+        summary.add_treatments([
+            {'created_at': '2020-01-01T23:30:00-05:00', 'insulin': 2}])
+        self.assertEqual([row['date'] for row in summary.rows()],
+                         ['2020-01-02'])
+
+    def test_invalid_treatment_dates_are_skipped(self):
+        summary = DailySummary()
+        summary.add_treatments([
+            {'created_at': '2020-13-45T00:00:00Z', 'insulin': 2},
+            {'created_at': '2020-01-01T12:00:00Z', 'carbs': 30}])
+        self.assertEqual(summary.rows(), [
+            {'date': '2020-01-01', 'readings': 0, 'insulin': 0, 'carbs': 30}])
+
+
+class ProbeTests(TestCase):
+    def setUp(self):
+        self.requests_get = requests.get
+
+    def tearDown(self):
+        requests.get = self.requests_get
+
+    def test_unreachable_host(self):
+        def get(url, **kwargs):
+            raise requests.exceptions.ConnectionError('Name not resolved')
+        requests.get = get
+        self.assertIsNone(probe_ns_site('dead.invalid'))
+
+    def test_status_that_is_not_json(self):
+        def get(url, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = b'<html>Not Nightscout</html>'
+            return response
+        requests.get = get
+        self.assertIsNone(probe_ns_site('html.invalid'))
+
+
+class UploadOnceTests(TestCase):
+    def setUp(self):
+        self.upload_file_to_oh = tasks.upload_file_to_oh
+        self.uploads = []
+        self.fail_on = None
+        tasks.upload_file_to_oh = self.upload_file_to_oh_stub
+
+    def tearDown(self):
+        tasks.upload_file_to_oh = self.upload_file_to_oh
+
+    def upload_file_to_oh_stub(self, oh_member, filepath, metadata):
+        if filepath == self.fail_on:
+            raise IOError('Upload failed')
+        self.uploads.append(filepath)
+
+    def run_task(self, run):
+        """
+        Upload one run's files the way add_data_to_open_humans does.
+        """
+        member = FakeMember()
+        tasks.upload_files_once(member, [
+            ('entries_{}.json.gz'.format(run), {}),
+            ('entries_{}.index.json'.format(run), {})], 'entries', 'task-1')
+        tasks.upload_files_once(member, [
+            ('treatments_{}.json.gz'.format(run), {})], 'treatments',
+            'task-1')
+        tasks.upload_files_once(member, [
+            ('profile_versions_{}.json.gz'.format(run), {}),
+            ('profile_index_{}.json'.format(run), {})], 'profile', 'task-1')
+
+    def test_redelivered_task_skips_uploaded_roles(self):
+        self.run_task(1)
+        # A redelivery writes the same roles with different content.
+        self.run_task(2)
+        self.assertEqual(self.uploads, [
+            'entries_1.json.gz', 'entries_1.index.json',
+            'treatments_1.json.gz', 'profile_versions_1.json.gz',
+            'profile_index_1.json'])
+
+    def test_entries_index_is_uploaded_with_its_data_file(self):
+        self.fail_on = 'entries_1.index.json'
+        with self.assertRaises(IOError):
+            self.run_task(1)
+        self.fail_on = None
+        self.run_task(2)
+        self.assertEqual(self.uploads, [
+            'entries_1.json.gz', 'entries_2.json.gz', 'entries_2.index.json',
+            'treatments_2.json.gz', 'profile_versions_2.json.gz',
+            'profile_index_2.json'])
+
+    def test_profile_index_is_uploaded_with_its_versions(self):
+        self.fail_on = 'profile_index_1.json'
+        with self.assertRaises(IOError):
+            self.run_task(1)
+        self.fail_on = None
+        self.run_task(2)
+        self.assertEqual(self.uploads, [
+            'entries_1.json.gz', 'entries_1.index.json',
+            'treatments_1.json.gz', 'profile_versions_1.json.gz',
+            'profile_versions_2.json.gz', 'profile_index_2.json'])
+
+
+class IndexedEntriesWriterTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmp_dir, 'entries.json.gz')
+        self.index_filepath = os.path.join(self.tmp_dir, 'entries-index.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, entries, window_hours=30):
+        """
+        Write entries in windows of window_hours, newest window first.
+        """
+        writer = IndexedEntriesWriter(self.filepath, self.index_filepath)
+        window = window_hours * 3600 * 1000
+        entries = sorted(entries, key=lambda entry: entry['date'])
+        end = entries[-1]['date'] + 1 if entries else 0
+        while entries:
+            window_items = [entry for entry in entries
+                            if entry['date'] >= end - window]
+            entries = entries[:len(entries) - len(window_items)]
+            writer.write_items(window_items)
+            end -= window
+        writer.finish()
+        with gzip.open(self.filepath) as f:
+            items = json.load(f)
+        with open(self.index_filepath) as f:
+            index = json.load(f)
+        return items, index
+
+    def test_entries_are_written_oldest_first(self):
+        entries = make_entries(arrow.get('2019-03-01T06:00'), 72, minutes=60)
+        items, index = self.write(entries)
+        self.assertEqual([item['_id'] for item in items],
+                         [entry['_id'] for entry in entries])
+
+    def test_one_block_per_utc_day(self):
+        # Windows of 30 hours end part way through days.
+        entries = make_entries(arrow.get('2019-03-01T06:00'), 72, minutes=60)
+        items, index = self.write(entries)
+        self.assertEqual(
+            [(block['day'], block['count']) for block in index['blocks']],
+            [('2019-03-01', 18), ('2019-03-02', 24), ('2019-03-03', 24),
+             ('2019-03-04', 6)])
+
+    def test_blocks_are_read_at_their_offsets(self):
+        entries = make_entries(arrow.get('2019-03-01T06:00'), 72, minutes=60)
+        items, index = self.write(entries)
+        read = []
+        for block in index['blocks']:
+            block_items = read_block(self.filepath, block)
+            self.assertEqual(len(block_items), block['count'])
+            self.assertEqual(block_items[0]['date'], block['start'])
+            self.assertEqual(block_items[-1]['date'], block['end'])
+            read.extend(block_items)
+        self.assertEqual(read, items)
+
+    def test_gaps_within_and_across_blocks(self):
+        entries = (
+            make_entries(arrow.get('2019-03-01T22:00'), 6) +
+            make_entries(arrow.get('2019-03-02T00:30'), 6) +
+            make_entries(arrow.get('2019-03-02T02:00'), 6))
+        items, index = self.write(entries)
+        self.assertEqual(
+            [(gap['start_date'], gap['minutes']) for gap in index['gaps']],
+            [('2019-03-01T22:25:00+00:00', 125),
+             ('2019-03-02T00:55:00+00:00', 65)])
+
+    def test_empty_crawl(self):
+        items, index = self.write([])
+        self.assertEqual(items, [])
+        self.assertEqual(index['blocks'], [])
+        self.assertEqual(index['gaps'], [])
+
+
+class BulkTransferTests(TestCase):
+    def setUp(self):
+        self.task = bulk_transfer.xfer_to_open_humans
+        self.queued = []
+        bulk_transfer.xfer_to_open_humans = self
+        self.tmp_dir = tempfile.mkdtemp()
+        for oh_id in ('1', '2', '3'):
+            OpenHumansMember.objects.create(
+                user=User.objects.create(username=oh_id), oh_id=oh_id,
+                access_token='a', refresh_token='r',
+                token_expires=arrow.get().datetime)
+
+    def tearDown(self):
+        bulk_transfer.xfer_to_open_humans = self.task
+        shutil.rmtree(self.tmp_dir)
+
+    def apply_async(self, kwargs, countdown):
+        self.queued.append(kwargs)
+
+    def bulk_transfer(self, csv_text):
+        csv_file = os.path.join(self.tmp_dir, 'cohort.csv')
+        with open(csv_file, 'w') as f:
+            f.write(csv_text)
+        out = StringIO()
+        call_command('bulk_transfer', csv_file, stdout=out)
+        return out.getvalue()
+
+    def test_tasks_are_sent_to_the_configured_broker(self):
+        self.assertEqual(self.task._get_app().conf.broker_url,
+                         CELERY_BROKER_URL)
+
+    def test_countdowns_must_fit_in_the_consumer_timeout(self):
+        consumer_timeout = bulk_transfer.CONSUMER_TIMEOUT
+        bulk_transfer.CONSUMER_TIMEOUT = bulk_transfer.TRANSFER_MAX_SECONDS
+        try:
+            with self.assertRaises(CommandError):
+                self.bulk_transfer('oh_id,nightscout_url\n'
+                                   '1,https://one.invalid\n'
+                                   '2,https://one.invalid\n')
+        finally:
+            bulk_transfer.CONSUMER_TIMEOUT = consumer_timeout
+        self.assertEqual(self.queued, [])
+
+    def test_missing_and_invalid_dates(self):
+        out = self.bulk_transfer(
+            'oh_id,nightscout_url,after_date,before_date\n'
+            '1,https://one.invalid\n'
+            '2,https://two.invalid,2019-01-01\n'
+            '3,https://three.invalid,2019-02-30,2019-03-01\n')
+        self.assertEqual(
+            [(kwargs['oh_id'], kwargs['ns_after'], kwargs['ns_before'])
+             for kwargs in self.queued],
+            [('1', '', ''), ('2', '2019-01-01', '')])
+        self.assertIn('invalid dates skipped: 3 (2019-02-30)', out)
+
+
+class ResponseCacheTests(SimpleTestCase):
+    url = 'https://ns.invalid/api/v1/entries.json'
+    params = {'count': 10}
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.settings = (response_cache.CACHE_DIR, response_cache.CACHE_TTL)
+        response_cache.CACHE_DIR = os.path.join(self.cache_dir, 'responses')
+
+    def tearDown(self):
+        response_cache.CACHE_DIR, response_cache.CACHE_TTL = self.settings
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_returns_what_was_put(self):
+        response_cache.put(self.url, self.params, b'[1, 2]')
+        self.assertEqual(response_cache.get(self.url, self.params), b'[1, 2]')
+
+    def test_entries_are_separate_per_url_and_params(self):
+        response_cache.put(self.url, self.params, b'[1, 2]')
+        self.assertIsNone(response_cache.get(
+            'https://other.invalid/api/v1/entries.json', self.params))
+        self.assertIsNone(response_cache.get(self.url, {'count': 11}))
+
+    def test_expired_entries_are_removed(self):
+        response_cache.put(self.url, self.params, b'[1, 2]')
+        response_cache.CACHE_TTL = -1
+        self.assertIsNone(response_cache.get(self.url, self.params))
+        self.assertEqual(os.listdir(response_cache.CACHE_DIR), [])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for count in range(3):
+            response_cache.put(self.url, {'count': count}, b'x' * 1000)
+        paths = sorted(
+            os.path.join(response_cache.CACHE_DIR, name)
+            for name in os.listdir(response_cache.CACHE_DIR))
+        now = time.time()
+        for age, path in enumerate(paths):
+            os.utime(path, (now - age, now - age))
+        response_cache.evict(max_bytes=os.path.getsize(paths[0]))
+        self.assertEqual(
+            [os.path.join(response_cache.CACHE_DIR, name)
+             for name in os.listdir(response_cache.CACHE_DIR)], paths[:1])
+
+    def test_entry_evicted_while_read_is_still_returned(self):
+        response_cache.put(self.url, self.params, b'[1, 2]')
+        utime = os.utime
+
+        def evicted(path, times):
+            raise OSError('No such file or directory')
+        os.utime = evicted
+        try:
+            content = response_cache.get(self.url, self.params)
+        finally:
+            os.utime = utime
+        self.assertEqual(content, b'[1, 2]')
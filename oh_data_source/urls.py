@@ -23,5 +23,6 @@ urlpatterns = [
     url(r'^$', views.home, name='home'),
     url(r'complete/?$', views.complete),
     url(r'transfer/?$', views.transfer, name='transfer'),
+    url(r'status/?$', views.transfer_status, name='transfer_status'),
     url(r'logout/?$', views.logout_view, name='logout'),
 ]
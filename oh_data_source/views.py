@@ -1,3 +1,5 @@
+import hashlib
+import json
 import logging
 import os
 
@@ -6,6 +8,9 @@ from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponseNotModified, JsonResponse
 from django.shortcuts import redirect, render
 from django.views.decorators.http import require_http_methods
 import requests
@@ -37,6 +42,21 @@ def oh_get_member_data(token):
     return None
 
 
+def oh_get_cached_member_data(oh_member):
+    """
+    Return member data for an OpenHumansMember, using the cache if possible.
+
+    Data is cached for OH_MEMBER_DATA_CACHE_TTL seconds, and dropped early
+    when a transfer finishes or the member's tokens change.
+    """
+    cache_key = oh_member.member_data_cache_key()
+    oh_data = cache.get(cache_key)
+    if oh_data is None:
+        oh_data = oh_get_member_data(oh_member.get_access_token())
+        cache.set(cache_key, oh_data, settings.OH_MEMBER_DATA_CACHE_TTL)
+    return oh_data
+
+
 def oh_code_to_member(code):
     """
     Exchange code for token, use this to create and return OpenHumansMember.
@@ -77,6 +97,7 @@ def oh_code_to_member(code):
                     expires_in=data['expires_in'])
                 logger.debug('Member {} created.'.format(oh_id))
             oh_member.save()
+            oh_member.clear_cached_member_data()
 
             return oh_member
         elif 'error' in req.json():
@@ -100,8 +121,8 @@ def home(request):
 
     if request.user.is_authenticated:
         context.update({
-            'oh_data': oh_get_member_data(
-                request.user.openhumansmember.get_access_token())
+            'oh_data': oh_get_cached_member_data(
+                request.user.openhumansmember)
         })
 
     return render(request, 'oh_data_source/index.html', context=context)
@@ -144,14 +165,47 @@ def transfer(request):
         oh_id=request.user.openhumansmember.oh_id,
         ns_before=request.POST['beforeDate'],
         ns_after=request.POST['afterDate'],
-        ns_url=request.POST['nightscoutURL'])
+        ns_url=request.POST['nightscoutURL'],
+        daily_summary=bool(request.POST.get('dailySummary')),
+        entry_types=request.POST.getlist('entryTypes'),
+        entry_core_fields=bool(request.POST.get('entryCoreFields')))
     ohmember = request.user.openhumansmember
     ohmember.last_xfer_datetime = arrow.get().format()
-    ohmember.last_xfer_status = 'Queued'
-    ohmember.save()
+    ohmember.save(update_fields=['last_xfer_datetime'])
+    ohmember.set_xfer_status('Queued')
     return redirect('home')
 
 
+def xfer_progress_etag(progress):
+    """
+    Return an ETag for transfer progress, which changes when it does.
+    """
+    serialized = json.dumps(progress, sort_keys=True, cls=DjangoJSONEncoder)
+    return '"{}"'.format(hashlib.md5(serialized).hexdigest())
+
+
+@login_required
+@require_http_methods(['GET'])
+def transfer_status(request):
+    """
+    Return the latest transfer progress as JSON.
+
+    Clients should send the last ETag in If-None-Match to get a cheap 304 if
+    nothing changed. Requests are answered at once (no long polling), so
+    they don't hold a sync gunicorn worker.
+    """
+    oh_member = request.user.openhumansmember
+    progress = oh_member.get_xfer_progress()
+    etag = xfer_progress_etag(progress)
+    if etag == request.META.get('HTTP_IF_NONE_MATCH'):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(progress)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
 @login_required
 @require_http_methods(['POST'])
 def logout_view(request):
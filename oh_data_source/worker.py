@@ -0,0 +1,34 @@
+"""
+Slim Celery entry point for transfer workers.
+
+Unlike celery.py, this does not autodiscover tasks across INSTALLED_APPS.
+Only the transfer task module is imported, and Django is set up with
+worker_settings.py, which leaves out the apps only the web site uses.
+
+With the gevent pool (-P gevent), psycopg2 is made cooperative, so a
+transfer waiting on the database doesn't block the others in the process.
+
+Start a worker with:
+  celery -A oh_data_source.worker worker
+"""
+# absolute_import prevents conflicts between project celery.py file
+# and the celery package.
+from __future__ import absolute_import
+
+import os
+
+from celery import Celery
+
+from .celery_config import CELERY_BROKER_URL, CELERY_CONFIG
+from .crawl_engine import gevent_patched
+
+if gevent_patched():
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                      'oh_data_source.worker_settings')
+
+app = Celery('oh_data_source', broker=CELERY_BROKER_URL,
+             include=['oh_data_source.tasks'])
+app.conf.update(CELERY_CONFIG)
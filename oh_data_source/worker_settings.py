@@ -0,0 +1,29 @@
+"""
+Django settings for the slim Celery worker (see worker.py).
+
+The worker only uses the ORM, so the apps and middleware used by the web
+site alone aren't loaded.
+"""
+from .crawl_engine import gevent_patched
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+
+    # Local apps. Update these if you add or change app names!
+    'oh_data_source',
+]
+
+MIDDLEWARE = []
+
+# Workers don't serve requests. Without a URLconf, Django's startup checks
+# don't import the views (and through them, the web-only apps).
+ROOT_URLCONF = None
+
+# Under the gevent pool each transfer runs on its own greenlet, with its own
+# database connection. Close it after each status update instead of keeping
+# one connection open per running transfer.
+if gevent_patched():
+    DATABASES['default']['CONN_MAX_AGE'] = 0  # noqa: F405
+    XFER_STATUS_CLOSE_DB = True
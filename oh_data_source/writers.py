@@ -0,0 +1,188 @@
+"""
+Writers for crawled Nightscout items.
+
+crawl_collection passes each window's items to a writer's write_items(), in
+crawl order (newest window first), then calls finish().
+
+JSONArrayWriter writes a plain JSON array to an open file.
+
+IndexedEntriesWriter writes entries as a gzipped JSON array in ascending time
+order, plus a sidecar JSON index. Each UTC day is its own gzip member, so a
+reader can seek to the days it needs and decompress only those (see
+read_block). The index lists, oldest first, each block's day, time range,
+item count, byte offset and length, and the sensor gaps found between sgv
+readings.
+"""
+import gzip
+import json
+import os
+import zlib
+
+import arrow
+
+from .records import dumps
+
+# sgv readings further apart than this are reported as sensor gaps.
+GAP_THRESHOLD_MINUTES = 15
+
+MS_PER_DAY = 24 * 60 * 60 * 1000
+
+
+class JSONArrayWriter(object):
+    """
+    Write items to file_obj as one JSON array.
+    """
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        # Start a JSON array.
+        self.file_obj.write('[')
+        # Entries after initial are preceded by commas.
+        self.initial_entry_done = False
+
+    def write_items(self, items):
+        for item in items:
+            if self.initial_entry_done:
+                self.file_obj.write(',')  # JSON array separator
+            else:
+                self.initial_entry_done = True
+            self.file_obj.write(dumps(item))
+
+    def finish(self):
+        self.file_obj.write(']')  # End of JSON array.
+
+
+def _gzip_member(file_obj, text):
+    """
+    Write text to file_obj as one complete gzip member.
+    """
+    member = gzip.GzipFile(fileobj=file_obj, mode='wb', mtime=0)
+    member.write(text)
+    member.close()
+
+
+def _ms_to_iso(ms):
+    return arrow.get(ms / 1000.0).isoformat()
+
+
+def _utc_day(item):
+    """
+    Return the number of the UTC day an entry is in.
+    """
+    return int(item.get('date') or 0) // MS_PER_DAY
+
+
+class IndexedEntriesWriter(object):
+    """
+    Write entries oldest first, one gzip member per UTC day, with an index.
+
+    Windows arrive newest first, so each block is compressed into a segments
+    file as it arrives and the blocks are copied out in reverse by finish().
+    A window's oldest day may continue in the next window, so it's held back
+    until then.
+    """
+    def __init__(self, filepath, index_filepath):
+        self.filepath = filepath
+        self.index_filepath = index_filepath
+        self.segments_filepath = filepath + '.segments'
+        self.segments = open(self.segments_filepath, 'wb')
+        self.blocks = []
+        self.gaps = []
+        # Entries of the oldest day seen so far, not yet written.
+        self.pending = []
+
+    def write_items(self, items):
+        days = {}
+        for item in list(items) + self.pending:
+            days.setdefault(_utc_day(item), []).append(item)
+        if not days:
+            return
+        self.pending = days.pop(min(days))
+        # Newest first, like the windows; finish() reverses the blocks.
+        for day in sorted(days, reverse=True):
+            self._write_block(days[day])
+
+    def _write_block(self, items):
+        items = sorted(items, key=lambda item: item.get('date') or 0)
+        offset = self.segments.tell()
+        _gzip_member(self.segments, ','.join(dumps(item) for item in items))
+        sgv_times = [item['date'] for item in items
+                     if item.get('type') == 'sgv' and item.get('date')]
+        self.gaps.extend(self._find_gaps(sgv_times))
+        self.blocks.append({
+            'first': items[0].get('date'),
+            'last': items[-1].get('date'),
+            'count': len(items),
+            'first_sgv': sgv_times[0] if sgv_times else None,
+            'last_sgv': sgv_times[-1] if sgv_times else None,
+            'segment_offset': offset,
+            'length': self.segments.tell() - offset,
+        })
+
+    @staticmethod
+    def _find_gaps(times):
+        threshold = GAP_THRESHOLD_MINUTES * 60 * 1000
+        return [(earlier, later) for earlier, later in zip(times, times[1:])
+                if later - earlier > threshold]
+
+    def finish(self):
+        if self.pending:
+            self._write_block(self.pending)
+            self.pending = []
+        self.segments.close()
+        blocks = list(reversed(self.blocks))
+
+        # Gaps spanning two blocks.
+        sgv_blocks = [block for block in blocks if block['first_sgv']]
+        for earlier, later in zip(sgv_blocks, sgv_blocks[1:]):
+            self.gaps.extend(self._find_gaps(
+                [earlier['last_sgv'], later['first_sgv']]))
+
+        with open(self.segments_filepath, 'rb') as segments, \
+                open(self.filepath, 'wb') as output:
+            _gzip_member(output, '[')
+            for i, block in enumerate(blocks):
+                if i:
+                    _gzip_member(output, ',')
+                block['offset'] = output.tell()
+                segments.seek(block['segment_offset'])
+                output.write(segments.read(block['length']))
+            _gzip_member(output, ']')
+        os.remove(self.segments_filepath)
+
+        index = {
+            'gap_threshold_minutes': GAP_THRESHOLD_MINUTES,
+            'blocks': [{
+                'day': arrow.get(block['first'] / 1000.0).format(
+                    'YYYY-MM-DD'),
+                'start': block['first'],
+                'end': block['last'],
+                'start_date': _ms_to_iso(block['first']),
+                'end_date': _ms_to_iso(block['last']),
+                'count': block['count'],
+                'offset': block['offset'],
+                'length': block['length'],
+            } for block in blocks if block['first'] and block['last']],
+            'gaps': [{
+                'start': start,
+                'end': end,
+                'start_date': _ms_to_iso(start),
+                'end_date': _ms_to_iso(end),
+                'minutes': int((end - start) / 60000),
+            } for start, end in sorted(self.gaps)],
+        }
+        with open(self.index_filepath, 'w') as f:
+            json.dump(index, f, sort_keys=True)
+
+
+def read_block(filepath, block):
+    """
+    Return the entries in one block of an indexed entries file.
+
+    block is one of the index's 'blocks'. Only that block is decompressed.
+    """
+    with open(filepath, 'rb') as f:
+        f.seek(block['offset'])
+        data = f.read(block['length'])
+    # wbits 16 + MAX_WBITS reads a gzip (rather than zlib) stream.
+    text = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+    return json.loads('[' + text.decode('utf-8') + ']')